@@ -1,13 +1,18 @@
+import asyncio
 import logging
 import os
+import signal
+import threading
+import time
 from dataclasses import dataclass
+from typing import Mapping, Optional
 
-from dotenv import load_dotenv
+from dotenv import dotenv_values, find_dotenv
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(frozen=True)
 class Settings:
     bot_token: str
     db_path: str
@@ -15,29 +20,223 @@ class Settings:
     admin_login: str
     admin_password: str
     backend_url: str
+    bot_mode: str = "polling"
+    webhook_url: str = ""
+    webhook_path: str = "/webhook"
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_secret: str = ""
+    webhook_max_concurrency: int = 100
+    db_mode: str = "wal"
+    db_readers: int = 4
+    db_write_behind: bool = False
+    db_flush_interval_ms: int = 50
+    db_flush_max_rows: int = 500
+    db_write_queue_size: int = 10000
+    db_flush_on_close: bool = True
+    log_queue_size: int = 10000
+    log_workers: int = 2
+    log_batch_size: int = 100
+    log_backpressure: str = "block"
+    log_drain_timeout: int = 10
+    user_cache_size: int = 100000
+    user_seen_window: int = 60
+    events_queue_size: int = 10000
+    events_batch_size: int = 200
+    event_bus: str = "local"
+    event_bus_path: str = "./data/events.db"
+    event_bus_poll_ms: int = 50
+    ws_queue_size: int = 1000
+    ws_overflow_policy: str = "drop_oldest"
+    ws_batch_ms: int = 50
+    ws_batch_max: int = 100
+    ws_replay_events: int = 10000
+    ws_replay_bytes: int = 8388608
+    stats_refresh_seconds: int = 300
+    stats_top_n: int = 10
+    etag_check_interval_ms: int = 1000
+    retention_days: int = 0
+    archive_dir: str = "./data/archive"
+    retention_batch_size: int = 500
+    retention_interval_seconds: int = 3600
+    retention_vacuum_pages: int = 1000
+    rollup_minute_days: int = 14
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    telegram_api_url: str = ""
+    broadcast_rate: int = 25
+    broadcast_chat_interval_ms: int = 1000
+    broadcast_chunk_size: int = 100
+    broadcast_concurrency: int = 20
+    broadcast_lease_seconds: int = 30
 
 
-def load_settings() -> Settings:
-    load_dotenv()
-    token = os.getenv("BOT_TOKEN", "").strip()
+def _get_str(env: Mapping[str, str], name: str, default: str) -> str:
+    return (env.get(name) or "").strip() or default
+
+
+def _get_int(env: Mapping[str, str], name: str, default: int) -> int:
+    raw = (env.get(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        raise ValueError(f"Environment variable {name} must be an integer, got {raw!r}.")
+
+
+def _get_bool(env: Mapping[str, str], name: str, default: bool) -> bool:
+    raw = (env.get(name) or "").strip().lower()
+    if not raw:
+        return default
+    return raw in ("1", "true", "yes", "on")
+
+
+def settings_from_env(env: Mapping[str, str]) -> Settings:
+    token = _get_str(env, "BOT_TOKEN", "")
     if not token:
         raise ValueError(
             "Environment variable BOT_TOKEN is missing or empty. "
             "Please set it in the .env file."
         )
-    db_path = os.getenv("DB_PATH", "./data/bot.db").strip() or "./data/bot.db"
-    auth_secret = os.getenv("AUTH_SECRET", "change_me_secret").strip() or "change_me_secret"
-    admin_login = os.getenv("ADMIN_LOGIN", "admin").strip() or "admin"
-    admin_password = os.getenv("ADMIN_PASSWORD", "admin2").strip() or "admin2"
-    backend_url = os.getenv("BACKEND_URL", "http://localhost:8011").strip() or "http://localhost:8011"
-    logger.debug("Settings loaded successfully.")
     return Settings(
         bot_token=token,
-        db_path=db_path,
-        auth_secret=auth_secret,
-        admin_login=admin_login,
-        admin_password=admin_password,
-        backend_url=backend_url,
+        db_path=_get_str(env, "DB_PATH", "./data/bot.db"),
+        auth_secret=_get_str(env, "AUTH_SECRET", "change_me_secret"),
+        admin_login=_get_str(env, "ADMIN_LOGIN", "admin"),
+        admin_password=_get_str(env, "ADMIN_PASSWORD", "admin2"),
+        backend_url=_get_str(env, "BACKEND_URL", "http://localhost:8011"),
+        bot_mode=_get_str(env, "BOT_MODE", "polling").lower(),
+        webhook_url=_get_str(env, "WEBHOOK_URL", ""),
+        webhook_path=_get_str(env, "WEBHOOK_PATH", "/webhook"),
+        webhook_host=_get_str(env, "WEBHOOK_HOST", "0.0.0.0"),
+        webhook_port=_get_int(env, "WEBHOOK_PORT", 8080),
+        webhook_secret=_get_str(env, "WEBHOOK_SECRET", ""),
+        webhook_max_concurrency=_get_int(env, "WEBHOOK_MAX_CONCURRENCY", 100),
+        db_mode=_get_str(env, "DB_MODE", "wal").lower(),
+        db_readers=_get_int(env, "DB_READERS", 4),
+        db_write_behind=_get_bool(env, "DB_WRITE_BEHIND", False),
+        db_flush_interval_ms=_get_int(env, "DB_FLUSH_INTERVAL_MS", 50),
+        db_flush_max_rows=_get_int(env, "DB_FLUSH_MAX_ROWS", 500),
+        db_write_queue_size=_get_int(env, "DB_WRITE_QUEUE_SIZE", 10000),
+        db_flush_on_close=_get_bool(env, "DB_FLUSH_ON_CLOSE", True),
+        log_queue_size=_get_int(env, "LOG_QUEUE_SIZE", 10000),
+        log_workers=_get_int(env, "LOG_WORKERS", 2),
+        log_batch_size=_get_int(env, "LOG_BATCH_SIZE", 100),
+        log_backpressure=_get_str(env, "LOG_BACKPRESSURE", "block").lower(),
+        log_drain_timeout=_get_int(env, "LOG_DRAIN_TIMEOUT", 10),
+        user_cache_size=_get_int(env, "USER_CACHE_SIZE", 100000),
+        user_seen_window=_get_int(env, "USER_SEEN_WINDOW", 60),
+        events_queue_size=_get_int(env, "EVENTS_QUEUE_SIZE", 10000),
+        events_batch_size=_get_int(env, "EVENTS_BATCH_SIZE", 200),
+        event_bus=_get_str(env, "EVENT_BUS", "local").lower(),
+        event_bus_path=_get_str(env, "EVENT_BUS_PATH", "./data/events.db"),
+        event_bus_poll_ms=_get_int(env, "EVENT_BUS_POLL_MS", 50),
+        ws_queue_size=_get_int(env, "WS_QUEUE_SIZE", 1000),
+        ws_overflow_policy=_get_str(env, "WS_OVERFLOW_POLICY", "drop_oldest").lower(),
+        ws_batch_ms=_get_int(env, "WS_BATCH_MS", 50),
+        ws_batch_max=_get_int(env, "WS_BATCH_MAX", 100),
+        ws_replay_events=_get_int(env, "WS_REPLAY_EVENTS", 10000),
+        ws_replay_bytes=_get_int(env, "WS_REPLAY_BYTES", 8388608),
+        stats_refresh_seconds=_get_int(env, "STATS_REFRESH_SECONDS", 300),
+        stats_top_n=_get_int(env, "STATS_TOP_N", 10),
+        etag_check_interval_ms=_get_int(env, "ETAG_CHECK_INTERVAL_MS", 1000),
+        retention_days=_get_int(env, "RETENTION_DAYS", 0),
+        archive_dir=_get_str(env, "ARCHIVE_DIR", "./data/archive"),
+        retention_batch_size=_get_int(env, "RETENTION_BATCH_SIZE", 500),
+        retention_interval_seconds=_get_int(env, "RETENTION_INTERVAL_SECONDS", 3600),
+        retention_vacuum_pages=_get_int(env, "RETENTION_VACUUM_PAGES", 1000),
+        rollup_minute_days=_get_int(env, "ROLLUP_MINUTE_DAYS", 14),
+        metrics_host=_get_str(env, "METRICS_HOST", "127.0.0.1"),
+        metrics_port=_get_int(env, "METRICS_PORT", 0),
+        telegram_api_url=_get_str(env, "TELEGRAM_API_URL", ""),
+        broadcast_rate=_get_int(env, "BROADCAST_RATE", 25),
+        broadcast_chat_interval_ms=_get_int(env, "BROADCAST_CHAT_INTERVAL_MS", 1000),
+        broadcast_chunk_size=_get_int(env, "BROADCAST_CHUNK_SIZE", 100),
+        broadcast_concurrency=_get_int(env, "BROADCAST_CONCURRENCY", 20),
+        broadcast_lease_seconds=_get_int(env, "BROADCAST_LEASE_SECONDS", 30),
     )
 
 
+class SettingsProvider:
+    """Process-wide settings, parsed once and shared by the bot and the backend.
+
+    ``get()`` returns the cached immutable :class:`Settings`. The .env file's
+    mtime is checked at most every ``check_interval`` seconds and the settings
+    are re-read when it changes, or on SIGHUP (see
+    :meth:`install_sighup_handler`). Real environment variables win over .env
+    values, as with ``load_dotenv``, except those that only repeat the value
+    .env had at the first load (docker-compose ``env_file``, a sourced .env):
+    those came from the file, so an edited .env replaces them.
+    """
+
+    def __init__(self, env_file: Optional[str] = None, check_interval: float = 2.0) -> None:
+        self._env_file = env_file
+        self.check_interval = check_interval
+        self._settings: Optional[Settings] = None
+        self._base_env: Optional[dict] = None
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def env_file(self) -> str:
+        if self._env_file is None:
+            self._env_file = find_dotenv() or ".env"
+        return self._env_file
+
+    def get(self) -> Settings:
+        settings = self._settings
+        if settings is None:
+            return self.reload(strict=True)
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            if self._file_mtime() != self._mtime:
+                return self.reload()
+        return settings
+
+    def reload(self, strict: bool = False) -> Settings:
+        """Re-read settings; keep the previous ones if the new .env is invalid."""
+        with self._lock:
+            mtime = self._file_mtime()
+            values = dotenv_values(self.env_file) if mtime is not None else {}
+            if self._base_env is None:
+                self._base_env = {k: v for k, v in os.environ.items() if values.get(k) != v}
+            env = {**{k: v for k, v in values.items() if v is not None}, **self._base_env}
+            try:
+                settings = settings_from_env(env)
+            except ValueError:
+                if strict or self._settings is None:
+                    raise
+                logger.exception("Invalid settings in %s; keeping the previous ones", self.env_file)
+                self._mtime = mtime
+                return self._settings
+            if self._settings is not None and settings != self._settings:
+                logger.info("Settings reloaded from %s", self.env_file)
+            self._settings = settings
+            self._mtime = mtime
+            self._next_check = time.monotonic() + self.check_interval
+            return settings
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.env_file).st_mtime
+        except OSError:
+            return None
+
+    def install_sighup_handler(self) -> None:
+        """Reload settings on SIGHUP (no-op where signals are unsupported)."""
+        if not hasattr(signal, "SIGHUP"):
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+        except (NotImplementedError, RuntimeError):
+            logger.debug("SIGHUP reload is not available in this process")
+
+
+settings_provider = SettingsProvider()
+
+
+def get_settings() -> Settings:
+    return settings_provider.get()
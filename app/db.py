@@ -1,35 +1,1315 @@
+import asyncio
+import base64
+import json
+import logging
 import os
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
 
 import aiosqlite
 
+from .metrics import REGISTRY, instrument_methods
+from .texts import next_in_rotation
+
+logger = logging.getLogger(__name__)
+
 ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Time columns of the log tables and user_stats. They hold integer epoch
+# milliseconds (ISO text in databases not migrated yet); API rows carry ISO.
+TIME_COLUMNS = (
+    "first_seen_at",
+    "last_seen_at",
+    "sent_at",
+    "received_at",
+    "last_greeting_at",
+    "last_message_at",
+)
+
+DB_MODES = ("default", "wal")
+
+# Applied to every connection in "wal" mode. The bot and the backend share the
+# database file, so writers wait on each other instead of failing with SQLITE_BUSY.
+WAL_CONNECTION_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+)
+
+# One write operation is a list of statements that must land in the same transaction.
+Statement = Tuple[str, Sequence[Any]]
+
+UPSERT_USER_SQL = """
+    INSERT INTO users (
+        tg_user_id, first_name, last_name, username, first_seen_at, last_seen_at,
+        username_key, name_key, last_name_key
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(tg_user_id) DO UPDATE SET
+        first_name=excluded.first_name,
+        last_name=excluded.last_name,
+        username=excluded.username,
+        last_seen_at=excluded.last_seen_at,
+        first_seen_at=COALESCE(users.first_seen_at, excluded.first_seen_at),
+        username_key=excluded.username_key,
+        name_key=excluded.name_key,
+        last_name_key=excluded.last_name_key
+"""
+
+INSERT_GREETING_SQL = """
+    INSERT INTO greetings_log (tg_user_id, greeting_id, sent_at)
+    VALUES (?, ?, ?)
+"""
+
+UPSERT_ROTATION_SQL = """
+    INSERT INTO greeting_rotation (tg_user_id, seed, position, catalog_version)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(tg_user_id) DO UPDATE SET
+        seed = excluded.seed,
+        position = excluded.position,
+        catalog_version = excluded.catalog_version
+"""
+
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages_log (tg_user_id, message_text, message_type, raw_payload, received_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def _ms_sql(expr: str) -> str:
+    """SQL for ``expr`` in epoch milliseconds: ISO text is converted, numbers kept."""
+    return (
+        f"CASE WHEN typeof({expr}) = 'text' "
+        f"THEN CAST(ROUND((julianday({expr}) - 2440587.5) * 86400000) AS INTEGER) "
+        f"ELSE {expr} END"
+    )
+
+
+def _iso_sql(expr: str) -> str:
+    """SQL for ``expr`` as ISO text (to the second): epoch milliseconds are converted."""
+    return (
+        f"CASE WHEN typeof({expr}) = 'integer' "
+        f"THEN strftime('%Y-%m-%dT%H:%M:%S', {expr} / 1000, 'unixepoch') "
+        f"ELSE {expr} END"
+    )
+
+
+def _user_stats_triggers(ts: Callable[[str], str] = lambda expr: expr) -> Tuple[str, ...]:
+    return tuple(
+        f"""
+    CREATE TRIGGER IF NOT EXISTS trg_{name}_user_stats
+    AFTER INSERT ON {table}
+    BEGIN
+        INSERT INTO user_stats (tg_user_id, {count}, {last})
+        VALUES (new.tg_user_id, 1, {ts("new." + column)})
+        ON CONFLICT(tg_user_id) DO UPDATE SET
+            {count} = {count} + 1,
+            {last} = MAX(
+                COALESCE({last}, excluded.{last}),
+                excluded.{last}
+            );
+    END
+    """
+        for name, table, count, last, column in (
+            ("greetings", "greetings_log", "greetings_count", "last_greeting_at", "sent_at"),
+            ("messages", "messages_log", "messages_count", "last_message_at", "received_at"),
+        )
+    )
+
+
+# Per-user counters kept current by triggers on the log tables, so user lists
+# never aggregate the logs. Counters are lifetime totals. Rows that existed
+# when the table was created are counted by the "user_stats_*" backfills;
+# until those are done, reads aggregate the logs instead.
+USER_STATS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        tg_user_id INTEGER PRIMARY KEY,
+        greetings_count INTEGER NOT NULL DEFAULT 0,
+        messages_count INTEGER NOT NULL DEFAULT 0,
+        last_greeting_at TEXT,
+        last_message_at TEXT
+    )
+    """,
+) + _user_stats_triggers()
+
+USER_STATS_BACKFILL = (
+    "DELETE FROM user_stats",
+    """
+    INSERT INTO user_stats (tg_user_id, greetings_count, last_greeting_at)
+    SELECT tg_user_id, COUNT(*), MAX(sent_at)
+    FROM greetings_log
+    GROUP BY tg_user_id
+    """,
+    """
+    INSERT INTO user_stats (tg_user_id, messages_count, last_message_at)
+    SELECT tg_user_id, COUNT(*), MAX(received_at)
+    FROM messages_log
+    GROUP BY tg_user_id
+    ON CONFLICT(tg_user_id) DO UPDATE SET
+        messages_count = excluded.messages_count,
+        last_message_at = excluded.last_message_at
+    """,
+)
+
+
+def _user_stats_count(table: str, count: str, last: str, column: str) -> str:
+    return f"""
+    INSERT INTO user_stats (tg_user_id, {count}, {last})
+    SELECT tg_user_id, COUNT(*), MAX({column})
+    FROM {table}
+    WHERE id > :copied AND id <= :upper
+    GROUP BY tg_user_id
+    ON CONFLICT(tg_user_id) DO UPDATE SET
+        {count} = {count} + excluded.{count},
+        {last} = MAX(COALESCE({last}, excluded.{last}), excluded.{last})
+    """
+
+
+USER_STATS_BACKFILLS: Dict[str, Tuple[str, str, Sequence[str]]] = {
+    "user_stats_greetings": (
+        "greetings_log",
+        "id",
+        (_user_stats_count("greetings_log", "greetings_count", "last_greeting_at", "sent_at"),),
+    ),
+    "user_stats_messages": (
+        "messages_log",
+        "id",
+        (_user_stats_count("messages_log", "messages_count", "last_message_at", "received_at"),),
+    ),
+}
+
+GREETINGS_SENT_COUNT_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS trg_greetings_sent_count
+    AFTER INSERT ON greetings_log
+    BEGIN
+        UPDATE greetings SET sent_count = sent_count + 1 WHERE id = new.greeting_id;
+    END
+"""
+
+# Work that is too large for a migration transaction is registered in
+# "backfill" by the migration and done by Database.finish_migrations in short
+# batches: rows of the job's table with copied < key <= target, target being
+# the highest key when the migration ran. Newer rows are handled by triggers.
+BACKFILL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS backfill (
+        name TEXT PRIMARY KEY,
+        copied INTEGER NOT NULL,
+        target INTEGER NOT NULL
+    )
+"""
+
+
+def _backfill_job(name: str, table: str, key: str = "id") -> str:
+    return f"""
+        INSERT INTO backfill (name, copied, target)
+        SELECT '{name}', IFNULL(MIN({key}), 1) - 1, IFNULL(MAX({key}), 0) FROM {table}
+    """
+
+
+# Greeting texts live in a catalog with stable ids; the log stores only the id.
+# Texts found in an existing log are kept in the catalog as inactive entries;
+# the "greetings_catalog" backfill adds them and sets greeting_id of the old
+# rows. The old greeting_text column goes away when the timestamp migration
+# rebuilds the table; until then the trigger below fills it for writers that
+# give only greeting_id.
+GREETINGS_CATALOG_MIGRATION = (
+    """
+    CREATE TABLE IF NOT EXISTS greetings (
+        id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL UNIQUE,
+        active INTEGER NOT NULL DEFAULT 1,
+        sent_count INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS greeting_rotation (
+        tg_user_id INTEGER PRIMARY KEY,
+        seed INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        catalog_version INTEGER NOT NULL
+    )
+    """,
+    "ALTER TABLE greetings_log ADD COLUMN greeting_id INTEGER REFERENCES greetings (id)",
+    # Re-inserts the row with its text and skips the original insert.
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_greetings_log_text
+    BEFORE INSERT ON greetings_log
+    WHEN new.greeting_text IS NULL
+    BEGIN
+        INSERT INTO greetings_log (tg_user_id, greeting_text, greeting_id, sent_at)
+        VALUES (
+            new.tg_user_id,
+            IFNULL((SELECT text FROM greetings WHERE id = new.greeting_id), ''),
+            new.greeting_id,
+            new.sent_at
+        );
+        SELECT RAISE(IGNORE);
+    END
+    """,
+    GREETINGS_SENT_COUNT_TRIGGER,
+    _backfill_job("greetings_catalog", "greetings_log"),
+)
+
+GREETINGS_CATALOG_BACKFILL = (
+    """
+    INSERT OR IGNORE INTO greetings (text, active)
+    SELECT greeting_text, 0
+    FROM greetings_log
+    WHERE id > :copied AND id <= :upper
+    GROUP BY greeting_text
+    ORDER BY MIN(id)
+    """,
+    """
+    UPDATE greetings_log
+    SET greeting_id = (SELECT g.id FROM greetings g WHERE g.text = greetings_log.greeting_text)
+    WHERE id > :copied AND id <= :upper
+    """,
+    """
+    UPDATE greetings
+    SET sent_count = sent_count + c.count
+    FROM (
+        SELECT greeting_id, COUNT(*) AS count FROM greetings_log
+        WHERE id > :copied AND id <= :upper
+        GROUP BY greeting_id
+    ) c
+    WHERE c.greeting_id = greetings.id
+    """,
+)
+
+
+def _fts_indexed(row: str) -> str:
+    # Rows below the "messages_fts" backfill watermark are not indexed yet;
+    # deleting them from the index would corrupt it.
+    return f"""NOT EXISTS (
+        SELECT 1 FROM backfill
+        WHERE name = 'messages_fts' AND {row}.id > copied AND {row}.id <= target
+    )"""
+
+
+# Full-text index over message texts. It is an external-content FTS5 table:
+# it stores only the index and reads texts from messages_log, and triggers
+# keep it in sync with inserts (one per row of an executemany as well),
+# retention deletes and edits. Messages that existed when it was created are
+# indexed by the "messages_fts" backfill; edits and deletes of those leave the
+# index alone until the backfill has reached them.
+MESSAGES_FTS_SCHEMA = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        message_text,
+        content='messages_log',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert
+    AFTER INSERT ON messages_log
+    WHEN new.message_text IS NOT NULL
+    BEGIN
+        INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+    AFTER DELETE ON messages_log
+    WHEN old.message_text IS NOT NULL AND {_fts_indexed("old")}
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message_text)
+        VALUES ('delete', old.id, old.message_text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update
+    AFTER UPDATE OF message_text ON messages_log
+    WHEN {_fts_indexed("old")}
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message_text)
+        SELECT 'delete', old.id, old.message_text WHERE old.message_text IS NOT NULL;
+        INSERT INTO messages_fts (rowid, message_text)
+        SELECT new.id, new.message_text WHERE new.message_text IS NOT NULL;
+    END
+    """,
+)
+
+MESSAGES_FTS_BACKFILL = (
+    """
+    INSERT INTO messages_fts (rowid, message_text)
+    SELECT id, message_text FROM messages_log
+    WHERE id > :copied AND id <= :upper AND message_text IS NOT NULL
+    """,
+)
+
+# Rollup granularities and the length of the ISO timestamp prefix that names
+# a bucket ("2025-01-01T10:05" for a minute). Buckets are named from ISO text
+# whatever the log stores, see _iso_sql.
+ROLLUP_GRANULARITIES: Dict[str, int] = {"minute": 16, "hour": 13, "day": 10}
+
+ROLLUP_METRICS = ("messages", "greetings", "active_users", "new_users")
+
+_GRANULARITIES_SQL = "(VALUES %s) g" % ", ".join(
+    f"('{name}', {width})" for name, width in ROLLUP_GRANULARITIES.items()
+)
+
+
+def _rollup_increment(metric_sql: str, ts: str, where: str = "true") -> str:
+    # "WHERE" keeps the upsert after a SELECT unambiguous for the parser.
+    return f"""
+        INSERT INTO stats_rollup (granularity, bucket, metric, value)
+        SELECT g.column1, substr({_iso_sql(ts)}, 1, g.column2), {metric_sql}, 1
+        FROM {_GRANULARITIES_SQL}
+        WHERE {where}
+        ON CONFLICT(granularity, bucket, metric) DO UPDATE SET value = value + 1;
+    """
+
+
+def _rollup_activity(user: str, ts: str) -> str:
+    seen = f"""
+        SELECT 1 FROM active_users_rollup a
+        WHERE a.granularity = g.column1
+            AND a.bucket = substr({_iso_sql(ts)}, 1, g.column2)
+            AND a.tg_user_id = {user}
+    """
+    return _rollup_increment("'active_users'", ts, where=f"NOT EXISTS ({seen})") + f"""
+        INSERT OR IGNORE INTO active_users_rollup (granularity, bucket, tg_user_id)
+        SELECT g.column1, substr({_iso_sql(ts)}, 1, g.column2), {user}
+        FROM {_GRANULARITIES_SQL};
+    """
+
+
+# Per-bucket counters for the time-series charts, kept current by triggers
+# like user_stats. Metrics: messages, "messages.<type>", greetings, new_users
+# and active_users (distinct users who sent a message or got a greeting; the
+# users seen per bucket are kept in active_users_rollup).
+ROLLUP_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS stats_rollup (
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (granularity, bucket, metric)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS active_users_rollup (
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        tg_user_id INTEGER NOT NULL,
+        PRIMARY KEY (granularity, bucket, tg_user_id)
+    ) WITHOUT ROWID
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_rollup
+    AFTER INSERT ON messages_log
+    BEGIN
+        {_rollup_increment("'messages'", "new.received_at")}
+        {_rollup_increment("'messages.' || new.message_type", "new.received_at")}
+        {_rollup_activity("new.tg_user_id", "new.received_at")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_greetings_rollup
+    AFTER INSERT ON greetings_log
+    BEGIN
+        {_rollup_increment("'greetings'", "new.sent_at")}
+        {_rollup_activity("new.tg_user_id", "new.sent_at")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_users_rollup
+    AFTER INSERT ON users
+    BEGIN
+        {_rollup_increment("'new_users'", "new.first_seen_at")}
+    END
+    """,
+)
+
+ROLLUP_BACKFILL = (
+    "DELETE FROM stats_rollup",
+    "DELETE FROM active_users_rollup",
+    f"""
+    INSERT INTO stats_rollup (granularity, bucket, metric, value)
+    SELECT g.column1, substr({_iso_sql('received_at')}, 1, g.column2), 'messages', COUNT(*)
+    FROM messages_log, {_GRANULARITIES_SQL}
+    GROUP BY 1, 2
+    """,
+    f"""
+    INSERT INTO stats_rollup (granularity, bucket, metric, value)
+    SELECT g.column1, substr({_iso_sql('received_at')}, 1, g.column2), 'messages.' || message_type, COUNT(*)
+    FROM messages_log, {_GRANULARITIES_SQL}
+    GROUP BY 1, 2, 3
+    """,
+    f"""
+    INSERT INTO stats_rollup (granularity, bucket, metric, value)
+    SELECT g.column1, substr({_iso_sql('sent_at')}, 1, g.column2), 'greetings', COUNT(*)
+    FROM greetings_log, {_GRANULARITIES_SQL}
+    GROUP BY 1, 2
+    """,
+    f"""
+    INSERT INTO stats_rollup (granularity, bucket, metric, value)
+    SELECT g.column1, substr({_iso_sql('first_seen_at')}, 1, g.column2), 'new_users', COUNT(*)
+    FROM users, {_GRANULARITIES_SQL}
+    GROUP BY 1, 2
+    """,
+    f"""
+    INSERT OR IGNORE INTO active_users_rollup (granularity, bucket, tg_user_id)
+    SELECT g.column1, substr({_iso_sql('received_at')}, 1, g.column2), tg_user_id
+    FROM messages_log, {_GRANULARITIES_SQL}
+    UNION
+    SELECT g.column1, substr({_iso_sql('sent_at')}, 1, g.column2), tg_user_id
+    FROM greetings_log, {_GRANULARITIES_SQL}
+    """,
+    """
+    INSERT INTO stats_rollup (granularity, bucket, metric, value)
+    SELECT granularity, bucket, 'active_users', COUNT(*)
+    FROM active_users_rollup
+    GROUP BY 1, 2
+    """,
+)
+
+
+def _rollup_count(metric_sql: str, table: str, ts: str) -> str:
+    return f"""
+    INSERT INTO stats_rollup (granularity, bucket, metric, value)
+    SELECT g.column1, substr({_iso_sql(ts)}, 1, g.column2), {metric_sql}, COUNT(*)
+    FROM {table}, {_GRANULARITIES_SQL}
+    WHERE id > :copied AND id <= :upper
+    GROUP BY 1, 2, 3
+    ON CONFLICT(granularity, bucket, metric) DO UPDATE SET value = value + excluded.value
+    """
+
+
+def _rollup_activity_count(table: str, ts: str) -> Tuple[str, str]:
+    # Counts the (bucket, user) pairs not seen yet before recording them.
+    seen = f"""
+        SELECT DISTINCT g.column1 AS granularity, substr({_iso_sql(ts)}, 1, g.column2) AS bucket, tg_user_id
+        FROM {table}, {_GRANULARITIES_SQL}
+        WHERE id > :copied AND id <= :upper
+    """
+    return (
+        f"""
+        INSERT INTO stats_rollup (granularity, bucket, metric, value)
+        SELECT granularity, bucket, 'active_users', COUNT(*)
+        FROM ({seen}) s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM active_users_rollup a
+            WHERE a.granularity = s.granularity
+                AND a.bucket = s.bucket
+                AND a.tg_user_id = s.tg_user_id
+        )
+        GROUP BY 1, 2
+        ON CONFLICT(granularity, bucket, metric) DO UPDATE SET value = value + excluded.value
+        """,
+        f"INSERT OR IGNORE INTO active_users_rollup (granularity, bucket, tg_user_id) {seen}",
+    )
+
+
+# Backfills adding the rows that existed when the rollups were created, on
+# top of what the triggers have counted since.
+ROLLUP_BACKFILLS: Dict[str, Tuple[str, str, Sequence[str]]] = {
+    "rollup_messages": (
+        "messages_log",
+        "id",
+        (
+            _rollup_count("'messages'", "messages_log", "received_at"),
+            _rollup_count("'messages.' || message_type", "messages_log", "received_at"),
+            *_rollup_activity_count("messages_log", "received_at"),
+        ),
+    ),
+    "rollup_greetings": (
+        "greetings_log",
+        "id",
+        (
+            _rollup_count("'greetings'", "greetings_log", "sent_at"),
+            *_rollup_activity_count("greetings_log", "sent_at"),
+        ),
+    ),
+    "rollup_users": ("users", "id", (_rollup_count("'new_users'", "users", "first_seen_at"),)),
+}
+
+
+# Mass broadcasts started from the admin API. Recipients are users with
+# id <= max_user_id, walked in id order; last_user_id is the checkpoint below
+# which every recipient has been handled. A running broadcast is owned by one
+# backend worker, which keeps heartbeat_at fresh; another worker may take it
+# over once the heartbeat is stale.
+BROADCASTS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT,
+        heartbeat_at TEXT,
+        owner TEXT,
+        max_user_id INTEGER NOT NULL,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status, id)",
+)
+
+BROADCAST_STATUSES = ("pending", "running", "paused", "done", "cancelled")
+
+REBUILD_MESSAGES_FTS_SQL = "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"
+
+SEARCH_ORDERS = ("rank", "recent")
+
+# Tables with timestamps and their columns, key first, in the order the
+# epoch-millisecond copies are filled.
+TIMESTAMP_TABLES: Dict[str, Tuple[str, ...]] = {
+    "users": (
+        "id", "tg_user_id", "first_name", "last_name", "username", "first_seen_at", "last_seen_at",
+        "username_key", "name_key", "last_name_key",
+    ),
+    "greetings_log": ("id", "tg_user_id", "greeting_id", "sent_at"),
+    "messages_log": (
+        "id", "tg_user_id", "message_text", "message_type", "raw_payload", "received_at"
+    ),
+    "user_stats": (
+        "tg_user_id", "greetings_count", "messages_count", "last_greeting_at", "last_message_at"
+    ),
+}
+
+
+def _ms_values(columns: Sequence[str], prefix: str = "") -> List[str]:
+    return [
+        _ms_sql(prefix + column) if column in TIME_COLUMNS else prefix + column for column in columns
+    ]
+
+
+def _as_ms(columns: Sequence[str], prefix: str = "") -> str:
+    return ", ".join(_ms_values(columns, prefix))
+
+
+def _mirror_triggers(table: str, columns: Sequence[str]) -> Tuple[str, ...]:
+    # No OR REPLACE here: a trigger inherits the conflict mode of the statement
+    # that fired it, and an upsert's DO UPDATE runs with ABORT. Updates of rows
+    # the batch copy has not reached yet are skipped; the copy reads them later.
+    key = columns[0]
+    values = _ms_values(columns, "new.")
+    assignments = ", ".join(f"{column} = {value}" for column, value in zip(columns, values))
+    return (
+        f"""
+        CREATE TRIGGER trg_{table}_mirror_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {table}_ms ({', '.join(columns)}) VALUES ({', '.join(values)});
+        END
+        """,
+        f"""
+        CREATE TRIGGER trg_{table}_mirror_update AFTER UPDATE ON {table}
+        BEGIN
+            UPDATE {table}_ms SET {assignments} WHERE {key} = old.{key};
+        END
+        """,
+        f"""
+        CREATE TRIGGER trg_{table}_mirror_delete AFTER DELETE ON {table}
+        BEGIN
+            DELETE FROM {table}_ms WHERE {key} = old.{key};
+        END
+        """,
+    )
+
+
+def _time_fix_trigger(table: str, columns: Sequence[str], event: str) -> str:
+    # Normalizes ISO text written by a process that has not noticed the
+    # switch yet; a no-op check for everyone else.
+    name = "insert" if event == "INSERT" else "update"
+    return f"""
+    CREATE TRIGGER trg_{table}_ms_{name}_text AFTER {event} ON {table}_ms
+    WHEN {" OR ".join(f"typeof(new.{column}) = 'text'" for column in columns)}
+    BEGIN
+        UPDATE {table}_ms SET {", ".join(f"{column} = {_ms_sql(column)}" for column in columns)}
+        WHERE id = new.id;
+    END
+    """
+
+
+# Typeahead search on users: search_key() forms of the username, of
+# "first last" and of the last name, each with an index for prefix ranges.
+# The indexes are partial, so creating them on a large table writes nothing
+# and users without a username or last name cost no index space. Every
+# process applies this migration when it starts, before it writes, so only
+# the users that existed before need their keys filled: the "user_search"
+# backfill does that through the search_key() SQL function.
+USER_SEARCH_KEYS = ("username_key", "name_key", "last_name_key")
+
+USER_SEARCH_SCHEMA = (
+    *(f"ALTER TABLE users ADD COLUMN {key} TEXT" for key in USER_SEARCH_KEYS),
+    *(
+        f"CREATE INDEX idx_users_{key} ON users ({key}) WHERE {key} IS NOT NULL"
+        for key in USER_SEARCH_KEYS
+    ),
+    _backfill_job("user_search", "users"),
+)
+
+# Same keys as user_search_keys().
+USER_SEARCH_BACKFILL = """
+    UPDATE users SET
+        username_key = search_key(ltrim(username, '@')),
+        name_key = search_key(IFNULL(first_name, '') || ' ' || IFNULL(last_name, '')),
+        last_name_key = search_key(last_name)
+    WHERE id > :copied AND id <= :upper
+"""
+
+# Log times move from ISO text to integer epoch milliseconds online.
+# Migration 8 creates "<table>_ms" copies with INTEGER time columns and
+# triggers that mirror every write to the old tables into them; the existing
+# rows are copied by "<table>_ms" backfills. Migration 9 swaps the tables in
+# one short transaction once every backfill is complete. The old tables are
+# kept as "<table>_iso" and emptied and dropped in batches afterwards.
+TIMESTAMP_SHADOW_TABLES = (
+    """
+    CREATE TABLE users_ms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_user_id INTEGER NOT NULL UNIQUE,
+        first_name TEXT,
+        last_name TEXT,
+        username TEXT,
+        first_seen_at INTEGER NOT NULL,
+        last_seen_at INTEGER NOT NULL,
+        username_key TEXT,
+        name_key TEXT,
+        last_name_key TEXT
+    )
+    """,
+    "CREATE INDEX idx_users_last_seen_ms ON users_ms (last_seen_at, id)",
+    *(
+        f"CREATE INDEX idx_users_{key}_ms ON users_ms ({key}) WHERE {key} IS NOT NULL"
+        for key in USER_SEARCH_KEYS
+    ),
+    """
+    CREATE TABLE greetings_log_ms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_user_id INTEGER NOT NULL,
+        greeting_id INTEGER REFERENCES greetings (id),
+        sent_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX idx_greetings_sent_ms ON greetings_log_ms (sent_at, id)",
+    "CREATE INDEX idx_greetings_user_sent_ms ON greetings_log_ms (tg_user_id, sent_at, id)",
+    """
+    CREATE TABLE messages_log_ms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_user_id INTEGER NOT NULL,
+        message_text TEXT,
+        message_type TEXT NOT NULL,
+        raw_payload TEXT,
+        received_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX idx_messages_received_ms ON messages_log_ms (received_at, id)",
+    "CREATE INDEX idx_messages_user_received_ms ON messages_log_ms (tg_user_id, received_at, id)",
+    "CREATE INDEX idx_messages_type_received_ms ON messages_log_ms (message_type, received_at, id)",
+    """
+    CREATE TABLE user_stats_ms (
+        tg_user_id INTEGER PRIMARY KEY,
+        greetings_count INTEGER NOT NULL DEFAULT 0,
+        messages_count INTEGER NOT NULL DEFAULT 0,
+        last_greeting_at INTEGER,
+        last_message_at INTEGER
+    )
+    """,
+    "CREATE INDEX idx_user_stats_greetings_ms ON user_stats_ms (greetings_count)",
+    _time_fix_trigger("users", ("first_seen_at", "last_seen_at"), "INSERT"),
+    _time_fix_trigger("users", ("first_seen_at", "last_seen_at"), "UPDATE OF first_seen_at, last_seen_at"),
+    _time_fix_trigger("greetings_log", ("sent_at",), "INSERT"),
+    _time_fix_trigger("messages_log", ("received_at",), "INSERT"),
+    *(_backfill_job(f"{table}_ms", table, columns[0]) for table, columns in TIMESTAMP_TABLES.items()),
+) + tuple(
+    trigger for table, columns in TIMESTAMP_TABLES.items() for trigger in _mirror_triggers(table, columns)
+)
+
+# Backfill jobs: name -> (table, key column, statements run for the rows
+# with :copied < key <= :upper). The timestamp copies keep rows the mirror
+# triggers already wrote, since those are newer.
+BACKFILLS: Dict[str, Tuple[str, str, Sequence[str]]] = {
+    **USER_STATS_BACKFILLS,
+    "greetings_catalog": ("greetings_log", "id", GREETINGS_CATALOG_BACKFILL),
+    "messages_fts": ("messages_log", "id", MESSAGES_FTS_BACKFILL),
+    "user_search": ("users", "id", (USER_SEARCH_BACKFILL,)),
+    **ROLLUP_BACKFILLS,
+    **{
+        f"{table}_ms": (
+            table,
+            columns[0],
+            (
+                f"INSERT OR IGNORE INTO {table}_ms ({', '.join(columns)}) "
+                f"SELECT {_as_ms(columns)} FROM {table} "
+                f"WHERE {columns[0]} > :copied AND {columns[0]} <= :upper",
+            ),
+        )
+        for table, columns in TIMESTAMP_TABLES.items()
+    },
+}
+
+TIMESTAMP_SWAP = (
+    *(
+        f"DROP TRIGGER IF EXISTS trg_{table}_mirror_{event}"
+        for table in TIMESTAMP_TABLES
+        for event in ("insert", "update", "delete")
+    ),
+    "DROP TRIGGER IF EXISTS trg_greetings_user_stats",
+    "DROP TRIGGER IF EXISTS trg_messages_user_stats",
+    "DROP TRIGGER IF EXISTS trg_greetings_sent_count",
+    "DROP TRIGGER IF EXISTS trg_greetings_log_text",
+    "DROP TRIGGER IF EXISTS trg_messages_fts_insert",
+    "DROP TRIGGER IF EXISTS trg_messages_fts_delete",
+    "DROP TRIGGER IF EXISTS trg_messages_fts_update",
+    "DROP TRIGGER IF EXISTS trg_messages_rollup",
+    "DROP TRIGGER IF EXISTS trg_greetings_rollup",
+    "DROP TRIGGER IF EXISTS trg_users_rollup",
+    *(
+        statement
+        for table in TIMESTAMP_TABLES
+        for statement in (
+            f"ALTER TABLE {table} RENAME TO {table}_iso",
+            f"ALTER TABLE {table}_ms RENAME TO {table}",
+        )
+    ),
+    *_user_stats_triggers(_ms_sql),
+    GREETINGS_SENT_COUNT_TRIGGER,
+    *MESSAGES_FTS_SCHEMA[1:],
+    *ROLLUP_SCHEMA[2:],
+)
+
+TIMESTAMP_LEGACY_TABLES = tuple(f"{table}_iso" for table in TIMESTAMP_TABLES)
+
+# Composite (sort key, id) indexes behind the keyset-paginated lists; they
+# replace the single-column log indexes of older databases. Building them on
+# a large existing database takes a while (about 2 s for 500k messages), once.
+LIST_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen_at, id)",
+    "DROP INDEX IF EXISTS idx_greetings_user",
+    "CREATE INDEX IF NOT EXISTS idx_greetings_sent ON greetings_log (sent_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_greetings_user_sent ON greetings_log (tg_user_id, sent_at, id)",
+    "DROP INDEX IF EXISTS idx_messages_user",
+    "DROP INDEX IF EXISTS idx_messages_type",
+    "CREATE INDEX IF NOT EXISTS idx_messages_received ON messages_log (received_at, id)",
+    """
+    CREATE INDEX IF NOT EXISTS idx_messages_user_received
+    ON messages_log (tg_user_id, received_at, id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_messages_type_received
+    ON messages_log (message_type, received_at, id)
+    """,
+)
+
+# Schema migrations applied on top of the base tables, in order. The position
+# in the list (1-based) is the PRAGMA user_version the database ends up with.
+MIGRATIONS: List[Sequence[str]] = [
+    USER_STATS_SCHEMA + (BACKFILL_SCHEMA,) + tuple(
+        _backfill_job(name, table) for name, (table, _, _) in USER_STATS_BACKFILLS.items()
+    ),
+    ("CREATE INDEX IF NOT EXISTS idx_user_stats_greetings ON user_stats (greetings_count)",)
+    + LIST_INDEXES,
+    GREETINGS_CATALOG_MIGRATION,
+    MESSAGES_FTS_SCHEMA + (_backfill_job("messages_fts", "messages_log"),),
+    ROLLUP_SCHEMA + tuple(
+        _backfill_job(name, table) for name, (table, _, _) in ROLLUP_BACKFILLS.items()
+    ),
+    BROADCASTS_SCHEMA,
+    USER_SEARCH_SCHEMA,
+    TIMESTAMP_SHADOW_TABLES,
+    TIMESTAMP_SWAP,
+]
+
+# Migrations that wait for online work: version -> query that returns true
+# once it may run. Until then the database stays at the previous version.
+MIGRATION_READY: Dict[int, str] = {
+    9: "SELECT NOT EXISTS (SELECT 1 FROM backfill WHERE copied < target)",
+}
+
+# From this version on the log tables store epoch milliseconds.
+TIMESTAMPS_VERSION = 9
+
+
+USER_SELECT = """
+    SELECT
+        u.id,
+        u.tg_user_id,
+        u.first_name,
+        u.last_name,
+        u.username,
+        u.first_seen_at,
+        u.last_seen_at,
+        IFNULL(s.greetings_count, 0) AS greetings_count,
+        IFNULL(s.messages_count, 0) AS messages_count,
+        s.last_greeting_at,
+        s.last_message_at
+    FROM users u
+    LEFT JOIN user_stats s ON s.tg_user_id = u.tg_user_id
+"""
+
+# USER_SELECT while the user_stats backfills are running: the counters come
+# from the logs (each a range of the per-user log indexes).
+USER_SELECT_FROM_LOGS = """
+    SELECT
+        u.id,
+        u.tg_user_id,
+        u.first_name,
+        u.last_name,
+        u.username,
+        u.first_seen_at,
+        u.last_seen_at,
+        (SELECT COUNT(*) FROM greetings_log WHERE tg_user_id = u.tg_user_id) AS greetings_count,
+        (SELECT COUNT(*) FROM messages_log WHERE tg_user_id = u.tg_user_id) AS messages_count,
+        (SELECT MAX(sent_at) FROM greetings_log WHERE tg_user_id = u.tg_user_id) AS last_greeting_at,
+        (SELECT MAX(received_at) FROM messages_log WHERE tg_user_id = u.tg_user_id) AS last_message_at
+    FROM users u
+"""
+
+# Typeahead: one index range of at most :limit rows per search key, plus an
+# exact tg_user_id match. The bare "matched" column comes from the row with
+# the smallest rank.
+USER_SEARCH_SQL = """
+    WITH hits (id, rank, matched) AS (
+        SELECT id, 0, '' FROM users WHERE tg_user_id = :tg_user_id
+        UNION ALL %s
+    )
+    %s
+    JOIN (SELECT id, MIN(rank) AS rank, matched FROM hits GROUP BY id) h ON h.id = u.id
+    ORDER BY h.rank, h.matched, u.id
+    LIMIT :limit
+""" % (
+    " UNION ALL ".join(
+        f"""
+        SELECT * FROM (
+            SELECT id, {rank} AS rank, {key} AS matched FROM users
+            WHERE {key} >= :term AND {key} < :upper
+            ORDER BY {key} LIMIT :limit
+        )
+        """
+        for rank, key in (
+            ("CASE WHEN username_key = :term THEN 1 ELSE 2 END", "username_key"),
+            ("3", "name_key"),
+            ("4", "last_name_key"),
+        )
+    ),
+    USER_SELECT,
+)
+
+# Exportable tables: SELECT, time column and table alias, see Database.export_rows.
+EXPORT_QUERIES: Dict[str, Tuple[str, str, str]] = {
+    "messages": (
+        """
+        SELECT m.id, m.tg_user_id, m.message_text, m.message_type, m.raw_payload, m.received_at
+        FROM messages_log m
+        """,
+        "received_at",
+        "m",
+    ),
+    "greetings": (
+        """
+        SELECT l.id, l.tg_user_id, l.greeting_id, g.text AS greeting_text, l.sent_at
+        FROM greetings_log l
+        LEFT JOIN greetings g ON g.id = l.greeting_id
+        """,
+        "sent_at",
+        "l",
+    ),
+    "users": (USER_SELECT, "last_seen_at", "u"),
+}
+
 
 def utc_now() -> str:
     return datetime.now(tz=timezone.utc).strftime(ISO_FORMAT)
 
 
+def parse_datetime(value: str) -> datetime:
+    """Parse an ISO date or datetime; naive values are taken as UTC."""
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def to_epoch_ms(value: Any) -> int:
+    """Epoch milliseconds of an ISO timestamp (rounded); integers pass through."""
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"Not a timestamp: {value!r}")
+    return (parse_datetime(value) - EPOCH + timedelta(microseconds=500)) // timedelta(milliseconds=1)
+
+
+def from_epoch_ms(value: int) -> str:
+    return (EPOCH + timedelta(milliseconds=value)).strftime(ISO_FORMAT)
+
+
+def iso_times(row: Any) -> Dict[str, Any]:
+    """Row as a dict with epoch-millisecond :data:`TIME_COLUMNS` turned into ISO text."""
+    item = dict(row)
+    for column in TIME_COLUMNS:
+        value = item.get(column)
+        if isinstance(value, int):
+            item[column] = from_epoch_ms(value)
+    return item
+
+
+def search_key(text: Optional[str]) -> Optional[str]:
+    """Form of a name compared by user search: NFKC, case-folded, "ё" as "е", single spaces."""
+    if not text:
+        return None
+    key = " ".join(unicodedata.normalize("NFKC", text).casefold().replace("ё", "е").split())
+    return key or None
+
+
+def user_search_keys(
+    username: Optional[str], first_name: Optional[str], last_name: Optional[str]
+) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """``USER_SEARCH_KEYS`` values of a user."""
+    full_name = " ".join(name for name in (first_name, last_name) if name)
+    return search_key((username or "").lstrip("@")), search_key(full_name), search_key(last_name)
+
+
+USER_PROFILE_SQL = "SELECT first_name, last_name, username FROM users WHERE tg_user_id = ?"
+
+
+def upsert_user_statement(
+    tg_user_id: int,
+    first_name: Optional[str],
+    last_name: Optional[str],
+    username: Optional[str],
+    seen_at: Any,
+) -> Statement:
+    params = (tg_user_id, first_name, last_name, username, seen_at, seen_at)
+    return UPSERT_USER_SQL, params + user_search_keys(username, first_name, last_name)
+
+
+def encode_cursor(sort_value: Any, row_id: int) -> str:
+    """Pack the sort key and id of the last row of a page into an opaque token."""
+    raw = json.dumps([sort_value, row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(row_id, int):
+        raise ValueError("invalid cursor")
+    return sort_value, row_id
+
+
+def fts_query(text: str) -> str:
+    """FTS5 query matching rows that contain every word of ``text``.
+
+    Each word is quoted, so user input never hits FTS5 query syntax.
+    """
+    words = text.split()
+    if not words:
+        raise ValueError("empty search query")
+    return " ".join('"%s"' % word.replace('"', '""') for word in words)
+
+
+def next_cursor(items: List[Dict[str, Any]], sort_key: str, limit: int) -> Optional[str]:
+    """Cursor for the page after ``items``, or None when this page is the last one."""
+    if len(items) < limit:
+        return None
+    last = items[-1]
+    return encode_cursor(last[sort_key], last["id"])
+
+
+DB_METHOD_SECONDS = REGISTRY.histogram(
+    "db_method_seconds", "Latency of Database methods, including waits for locks.", ("method",)
+)
+DB_METHOD_ERRORS = REGISTRY.counter(
+    "db_method_errors_total", "Database method calls that raised.", ("method",)
+)
+
+
+def _log_task_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Database background task %s died", task.get_name(), exc_info=task.exception())
+
+
+@instrument_methods(DB_METHOD_SECONDS, DB_METHOD_ERRORS)
 class Database:
-    def __init__(self, conn: aiosqlite.Connection, db_path: str) -> None:
+    """SQLite repository.
+
+    By default every write is committed on its own. With ``write_behind=True``
+    writes are put on a bounded in-memory queue and a background task commits
+    them in one transaction as soon as ``flush_max_rows`` statements are
+    collected or ``flush_interval_ms`` passed since the oldest queued write,
+    whichever comes first. A full queue makes writers wait. Reads do not see
+    writes that are still queued.
+    """
+
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        db_path: str,
+        write_behind: bool = False,
+        flush_interval_ms: int = 50,
+        flush_max_rows: int = 500,
+        write_queue_size: int = 10000,
+        flush_on_close: bool = True,
+    ) -> None:
         self._conn = conn
         self.db_path = db_path
+        self._write_lock = asyncio.Lock()
+        self._flush_interval = max(flush_interval_ms, 0) / 1000
+        self._flush_max_rows = max(flush_max_rows, 1)
+        self._flush_on_close = flush_on_close
+        self._write_queue: Optional[asyncio.Queue] = (
+            asyncio.Queue(maxsize=max(write_queue_size, 1)) if write_behind else None
+        )
+        self._flusher: Optional[asyncio.Task] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._catalog: Optional[Dict[int, str]] = None
+        # Per-user locks of next_greeting and, in write-behind mode, the last
+        # rotation state picked per user, since its upsert may still be queued.
+        # At most a full queue plus one flush batch of writes are pending, so
+        # an entry that old has landed and can be evicted.
+        self._rotation_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = (
+            weakref.WeakValueDictionary()
+        )
+        self._rotations: "OrderedDict[int, Tuple[int, int, int]]" = OrderedDict()
+        self._rotations_max = self._flush_max_rows + max(write_queue_size, 1)
+        self.commits = 0
+        self._version_conn: Optional[aiosqlite.Connection] = None
+        self._version = 0
+        self._version_checked_at = 0.0
+        self._migrator: Optional[asyncio.Task] = None
 
     @classmethod
-    async def create(cls, db_path: str) -> "Database":
+    async def create(
+        cls,
+        db_path: str,
+        mode: str = "default",
+        readers: int = 0,
+        write_behind: bool = False,
+        flush_interval_ms: int = 50,
+        flush_max_rows: int = 500,
+        write_queue_size: int = 10000,
+        flush_on_close: bool = True,
+        migrate_online: bool = False,
+    ) -> "Database":
+        """Open the database.
+
+        ``mode="wal"`` switches the file to WAL journaling with
+        ``synchronous=NORMAL`` and sets busy timeout, mmap and cache size on
+        every connection. ``readers`` opens that many extra read-only
+        connections used by the list/stats queries, so dashboard reads run in
+        parallel with each other and with writes (WAL mode only).
+        ``migrate_online`` runs :meth:`finish_migrations` in the background
+        if the database still has online migrations pending.
+        """
+        if mode not in DB_MODES:
+            raise ValueError(f"Unknown database mode {mode!r}, expected one of {DB_MODES}.")
         if db_path:
             os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
         conn = await aiosqlite.connect(db_path)
         conn.row_factory = aiosqlite.Row
-        db = cls(conn, db_path)
+        # Used by the "user_search" backfill.
+        await conn.create_function("search_key", 1, search_key, deterministic=True)
+        # Only takes effect on a new file; existing ones need enable_incremental_vacuum().
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if mode == "wal":
+            await conn.execute("PRAGMA journal_mode = WAL")
+            await conn.execute("PRAGMA synchronous = NORMAL")
+            for pragma in WAL_CONNECTION_PRAGMAS:
+                await conn.execute(pragma)
+        db = cls(
+            conn,
+            db_path,
+            write_behind=write_behind,
+            flush_interval_ms=flush_interval_ms,
+            flush_max_rows=flush_max_rows,
+            write_queue_size=write_queue_size,
+            flush_on_close=flush_on_close,
+        )
         await db._init_schema()
+        db._version = await db._schema_version()
+        if migrate_online and await db.migrations_pending():
+            db._migrator = asyncio.create_task(db._migrate_in_background())
+            db._migrator.add_done_callback(_log_task_failure)
+        if mode == "wal" and readers > 0 and db_path and db_path != ":memory:":
+            await db._open_readers(readers)
+        if db._write_queue is not None:
+            db._flusher = asyncio.create_task(db._flush_loop())
+            db._flusher.add_done_callback(_log_task_failure)
         return db
 
+    async def _open_readers(self, count: int) -> None:
+        uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        self._reader_pool = asyncio.Queue()
+        for _ in range(count):
+            reader = await aiosqlite.connect(uri, uri=True)
+            reader.row_factory = aiosqlite.Row
+            for pragma in WAL_CONNECTION_PRAGMAS:
+                await reader.execute(pragma)
+            self._readers.append(reader)
+            self._reader_pool.put_nowait(reader)
+
+    @asynccontextmanager
+    async def _reading(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a read-only connection, or the main one if there is no pool."""
+        if self._reader_pool is None:
+            yield self._conn
+            return
+        reader = await self._reader_pool.get()
+        try:
+            yield reader
+        finally:
+            self._reader_pool.put_nowait(reader)
+
+    async def data_version(self) -> int:
+        """``PRAGMA data_version`` of a connection of its own, so it moves on every
+        commit made through any other connection, this process's writer included.
+        """
+        if not self.db_path or self.db_path == ":memory:":
+            conn = self._conn
+        else:
+            if self._version_conn is None:
+                self._version_conn = await aiosqlite.connect(self.db_path)
+            conn = self._version_conn
+        cursor = await conn.execute("PRAGMA data_version")
+        return (await cursor.fetchone())[0]
+
+    @property
+    def write_behind(self) -> bool:
+        return self._write_queue is not None
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of write operations waiting to be committed."""
+        return self._write_queue.qsize() if self._write_queue is not None else 0
+
+    async def flush(self) -> None:
+        """Wait until every queued write is committed."""
+        if self._write_queue is not None:
+            await self._write_queue.join()
+
     async def close(self) -> None:
+        if self._migrator:
+            self._migrator.cancel()
+            try:
+                await self._migrator
+            except asyncio.CancelledError:
+                pass
+            self._migrator = None
+        if self._flusher:
+            if self._flush_on_close:
+                await self.flush()
+            elif self.queue_depth:
+                logger.warning("Dropping %s queued writes on close", self.queue_depth)
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._version_conn is not None:
+            await self._version_conn.close()
+            self._version_conn = None
+        for reader in self._readers:
+            await reader.close()
+        self._readers = []
+        self._reader_pool = None
         await self._conn.close()
 
+    async def _commit(self) -> None:
+        await self._conn.commit()
+        self.commits += 1
+
+    async def _write(self, statements: List[Statement]) -> None:
+        if self._write_queue is not None:
+            await self._write_queue.put(statements)
+            return
+        async with self._write_lock:
+            try:
+                await self._execute_statements(statements)
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+
+    async def _execute_statements(self, statements: List[Statement]) -> None:
+        # Consecutive statements with the same SQL go through one executemany call.
+        for sql, group in groupby(statements, key=lambda st: st[0]):
+            params = [p for _, p in group]
+            if len(params) == 1:
+                await self._conn.execute(sql, params[0])
+            else:
+                await self._conn.executemany(sql, params)
+
+    async def _flush_loop(self) -> None:
+        assert self._write_queue is not None
+        queue = self._write_queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            rows = len(batch[0])
+            deadline = loop.time() + self._flush_interval
+            while rows < self._flush_max_rows:
+                if queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        op = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    op = queue.get_nowait()
+                batch.append(op)
+                rows += len(op)
+            try:
+                await self._commit_batch(batch)
+            except Exception:
+                # Typically a rollback that failed too; the loop must outlive it,
+                # or writers would block on the full queue forever.
+                logger.exception("Dropping %s queued writes after a failed flush", len(batch))
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _commit_batch(self, batch: List[List[Statement]]) -> None:
+        async with self._write_lock:
+            try:
+                await self._execute_statements([st for op in batch for st in op])
+                await self._commit()
+                return
+            except Exception:
+                await self._conn.rollback()
+                logger.exception("Group commit of %s writes failed; retrying one by one", len(batch))
+            for op in batch:
+                try:
+                    await self._execute_statements(op)
+                    await self._commit()
+                except Exception:
+                    await self._conn.rollback()
+                    logger.exception("Dropping queued write that cannot be committed")
+
     async def _init_schema(self) -> None:
+        # The base tables below are the pre-epoch-milliseconds ones; once
+        # migrated, the database has the current tables already. Indexes are
+        # created by MIGRATIONS, so a start does not build any by itself.
+        if await self._schema_version() >= TIMESTAMPS_VERSION:
+            await self._migrate()
+            return
         await self._conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -48,7 +1328,6 @@ class Database:
                 greeting_text TEXT NOT NULL,
                 sent_at TEXT NOT NULL
             );
-            CREATE INDEX IF NOT EXISTS idx_greetings_user ON greetings_log (tg_user_id);
 
             CREATE TABLE IF NOT EXISTS messages_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -58,11 +1337,215 @@ class Database:
                 raw_payload TEXT,
                 received_at TEXT NOT NULL
             );
-            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages_log (tg_user_id);
-            CREATE INDEX IF NOT EXISTS idx_messages_type ON messages_log (message_type);
             """
         )
-        await self._conn.commit()
+        await self._commit()
+        await self._migrate()
+
+    async def _schema_version(self) -> int:
+        cursor = await self._conn.execute("PRAGMA user_version")
+        return (await cursor.fetchone())[0]
+
+    async def _migrate(self) -> None:
+        if await self._schema_version() >= len(MIGRATIONS):
+            return
+        for version, statements in enumerate(MIGRATIONS, start=1):
+            # The bot and the backend may start at the same time: take the write
+            # lock first and re-check, so each migration runs exactly once.
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if await self._schema_version() < version and version in MIGRATION_READY:
+                    cursor = await self._conn.execute(MIGRATION_READY[version])
+                    if not (await cursor.fetchone())[0]:
+                        await self._conn.rollback()
+                        logger.info("Database migration %s waits for online work", version)
+                        return
+                if await self._schema_version() < version:
+                    logger.info("Applying database migration %s", version)
+                    for statement in statements:
+                        await self._conn.execute(statement)
+                    await self._conn.execute(f"PRAGMA user_version = {version}")
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+
+    async def _schema_at_least(self, version: int) -> bool:
+        # Another process may migrate; look again at most once a second.
+        if self._version < version and time.monotonic() >= self._version_checked_at + 1.0:
+            self._version_checked_at = time.monotonic()
+            self._version = await self._schema_version()
+        return self._version >= version
+
+    async def _uses_epoch_ms(self) -> bool:
+        return await self._schema_at_least(TIMESTAMPS_VERSION)
+
+    async def _time_param(self, value: Any) -> Any:
+        """A timestamp in the format the log tables store it in."""
+        return to_epoch_ms(value) if await self._uses_epoch_ms() else value
+
+    async def migrations_pending(self) -> bool:
+        """True until every online migration (see :meth:`finish_migrations`) is done."""
+        if await self._schema_version() < TIMESTAMPS_VERSION:
+            return True
+        cursor = await self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name IN (%s)"
+            % ",".join("?" * len(TIMESTAMP_LEGACY_TABLES)),
+            TIMESTAMP_LEGACY_TABLES,
+        )
+        return await cursor.fetchone() is not None
+
+    async def backfill_pending(self, *names: str) -> bool:
+        """True while any of the backfill jobs ``names`` has rows left to process."""
+        async with self._reading() as conn:
+            cursor = await conn.execute(
+                "SELECT 1 FROM backfill WHERE name IN (%s) AND copied < target"
+                % ",".join("?" * len(names)),
+                names,
+            )
+            return await cursor.fetchone() is not None
+
+    async def finish_migrations(self, batch_size: int = 2000, pause: float = 0.05) -> None:
+        """Do the work migrations left for later without long write locks.
+
+        Runs the backfill jobs in batches of ``batch_size`` rows, each in its
+        own transaction, pausing ``pause`` seconds (or as long as the batch
+        took, if longer) in between for other writers, then applies the
+        migrations that waited for them (the switch to epoch-millisecond
+        tables) and empties and drops the old tables the same way. Resumes
+        where it stopped; several processes may run it at once.
+        """
+        if await self._schema_version() < TIMESTAMPS_VERSION:
+            logger.info("Running database backfills")
+            await self._in_batches(lambda: self._backfill_batch(batch_size), pause)
+            async with self._write_lock:
+                await self._migrate()
+            if await self._schema_version() < TIMESTAMPS_VERSION:
+                raise RuntimeError("timestamp migration did not complete")
+            logger.info("Log tables switched to epoch milliseconds")
+        self._version = await self._schema_version()
+        for table in TIMESTAMP_LEGACY_TABLES:
+            await self._in_batches(lambda: self._drop_legacy_batch(table, batch_size), pause)
+        await self.flush()
+
+    async def _in_batches(self, batch: Callable[[], Awaitable[bool]], pause: float) -> None:
+        # Other writers get at least as long as the last batch took, so heavy
+        # batches cannot starve them.
+        while True:
+            started = time.monotonic()
+            if not await batch():
+                return
+            await asyncio.sleep(max(pause, time.monotonic() - started))
+
+    async def _migrate_in_background(self) -> None:
+        try:
+            await self.finish_migrations()
+        except Exception:
+            logger.exception("Online migration failed; it resumes on the next start")
+
+    async def _backfill_batch(self, batch_size: int) -> bool:
+        """Process the next batch of the oldest pending backfill; False once none is left."""
+        async with self._write_lock:
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = await self._conn.execute(
+                    "SELECT name, copied, target FROM backfill WHERE copied < target "
+                    "ORDER BY rowid LIMIT 1"
+                )
+                row = await cursor.fetchone()
+                if row is None:
+                    await self._conn.rollback()
+                    return False
+                name, copied, target = row
+                table, key, statements = BACKFILLS[name]
+                cursor = await self._conn.execute(
+                    f"""
+                    SELECT MAX({key}) FROM (
+                        SELECT {key} FROM {table} WHERE {key} > ? AND {key} <= ? ORDER BY {key} LIMIT ?
+                    )
+                    """,
+                    (copied, target, batch_size),
+                )
+                upper = (await cursor.fetchone())[0]
+                if upper is None:
+                    upper = target
+                else:
+                    for statement in statements:
+                        await self._conn.execute(statement, {"copied": copied, "upper": upper})
+                await self._conn.execute(
+                    "UPDATE backfill SET copied = ? WHERE name = ?", (upper, name)
+                )
+                if upper == target:
+                    logger.info("Backfill %s is complete", name)
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+        return True
+
+    async def _drop_legacy_batch(self, table: str, batch_size: int) -> bool:
+        """Delete a batch of rows of an old table, dropping it once empty; False when gone."""
+        async with self._write_lock:
+            cursor = await self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            )
+            if await cursor.fetchone() is None:
+                return False
+            try:
+                cursor = await self._conn.execute(
+                    f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} LIMIT ?)",
+                    (batch_size,),
+                )
+                if cursor.rowcount == 0:
+                    await self._conn.execute(f"DROP TABLE {table}")
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+        return True
+
+    async def auto_vacuum_mode(self) -> int:
+        """``PRAGMA auto_vacuum``: 0 none, 1 full, 2 incremental."""
+        cursor = await self._conn.execute("PRAGMA auto_vacuum")
+        return (await cursor.fetchone())[0]
+
+    async def enable_incremental_vacuum(self) -> None:
+        """Switch an existing file to incremental auto-vacuum.
+
+        Runs a full VACUUM, which rewrites the whole file and blocks every
+        writer until it finishes; meant for a one-off run during maintenance.
+        """
+        await self.flush()
+        async with self._write_lock:
+            await self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await self._conn.execute("VACUUM")
+
+    async def incremental_vacuum(self, pages: int) -> int:
+        """Return up to ``pages`` free pages to the OS; returns how many were freed."""
+        async with self._write_lock:
+            cursor = await self._conn.execute("PRAGMA freelist_count")
+            before = (await cursor.fetchone())[0]
+            # executescript steps the pragma to completion; execute() frees one page.
+            await self._conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            cursor = await self._conn.execute("PRAGMA freelist_count")
+            after = (await cursor.fetchone())[0]
+        return before - after
+
+    async def rebuild_user_stats(self) -> None:
+        """Recompute per-user counters from the logs (archived messages are not counted).
+
+        Also completes the user_stats backfills if they are still running.
+        """
+        await self._write(
+            [(statement, ()) for statement in USER_STATS_BACKFILL]
+            + [
+                (
+                    "UPDATE backfill SET copied = target WHERE name IN (%s)"
+                    % ",".join("?" * len(USER_STATS_BACKFILLS)),
+                    tuple(USER_STATS_BACKFILLS),
+                )
+            ]
+        )
 
     async def upsert_user(
         self,
@@ -71,37 +1554,94 @@ class Database:
         last_name: Optional[str],
         username: Optional[str],
         seen_at: Optional[str] = None,
-    ) -> None:
-        seen = seen_at or utc_now()
-        await self._conn.execute(
-            """
-            INSERT INTO users (
-                tg_user_id, first_name, last_name, username, first_seen_at, last_seen_at
+    ) -> Tuple[bool, bool]:
+        """Insert or refresh a user.
+
+        Returns ``(created, changed)``: whether the row is new and whether an
+        existing row had a different name or username. In write-behind mode
+        both come from the committed row, so they miss writes still queued.
+        """
+        seen = await self._time_param(seen_at or utc_now())
+        sql, params = upsert_user_statement(tg_user_id, first_name, last_name, username, seen)
+        if self.write_behind:
+            async with self._reading() as conn:
+                cursor = await conn.execute(USER_PROFILE_SQL, (tg_user_id,))
+                row = await cursor.fetchone()
+            await self._write([(sql, params)])
+        else:
+            async with self._write_lock:
+                try:
+                    cursor = await self._conn.execute(USER_PROFILE_SQL, (tg_user_id,))
+                    row = await cursor.fetchone()
+                    await self._conn.execute(sql, params)
+                    await self._commit()
+                except Exception:
+                    await self._conn.rollback()
+                    raise
+        if row is None:
+            return True, False
+        return False, tuple(row) != (first_name, last_name, username)
+
+    async def sync_greetings(self, texts: Sequence[str]) -> None:
+        """Make ``texts`` the active greeting catalog, keeping ids of known texts."""
+        async with self._write_lock:
+            try:
+                await self._conn.execute("UPDATE greetings SET active = 0")
+                await self._conn.executemany(
+                    """
+                    INSERT INTO greetings (text, active) VALUES (?, 1)
+                    ON CONFLICT(text) DO UPDATE SET active = 1
+                    """,
+                    [(text,) for text in texts],
+                )
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+        self._catalog = None
+
+    async def _active_greetings(self) -> Dict[int, str]:
+        if self._catalog is None:
+            cursor = await self._conn.execute(
+                "SELECT id, text FROM greetings WHERE active = 1 ORDER BY id"
             )
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(tg_user_id) DO UPDATE SET
-                first_name=excluded.first_name,
-                last_name=excluded.last_name,
-                username=excluded.username,
-                last_seen_at=excluded.last_seen_at,
-                first_seen_at=COALESCE(users.first_seen_at, excluded.first_seen_at)
-            """,
-            (tg_user_id, first_name, last_name, username, seen, seen),
-        )
-        await self._conn.commit()
+            self._catalog = {row["id"]: row["text"] for row in await cursor.fetchall()}
+        return self._catalog
+
+    async def next_greeting(self, tg_user_id: int) -> Optional[Tuple[int, str]]:
+        """Next greeting of the user's no-repeat rotation, or None if the catalog is empty."""
+        catalog = await self._active_greetings()
+        if not catalog:
+            return None
+        lock = self._rotation_locks.get(tg_user_id)
+        if lock is None:
+            lock = self._rotation_locks[tg_user_id] = asyncio.Lock()
+        # Concurrent greetings for one user take turns, so each one sees the
+        # step the previous one picked.
+        async with lock:
+            state = self._rotations.get(tg_user_id)
+            if state is None:
+                cursor = await self._conn.execute(
+                    "SELECT seed, position, catalog_version FROM greeting_rotation "
+                    "WHERE tg_user_id = ?",
+                    (tg_user_id,),
+                )
+                row = await cursor.fetchone()
+                state = (row["seed"], row["position"], row["catalog_version"]) if row else None
+            greeting_id, state = next_in_rotation(list(catalog), state)
+            if self.write_behind:
+                self._rotations[tg_user_id] = state
+                self._rotations.move_to_end(tg_user_id)
+                while len(self._rotations) > self._rotations_max:
+                    self._rotations.popitem(last=False)
+            await self._write([(UPSERT_ROTATION_SQL, (tg_user_id, *state))])
+        return greeting_id, catalog[greeting_id]
 
     async def add_greeting(
-        self, tg_user_id: int, greeting_text: str, sent_at: Optional[str] = None
+        self, tg_user_id: int, greeting_id: int, sent_at: Optional[str] = None
     ) -> None:
-        ts = sent_at or utc_now()
-        await self._conn.execute(
-            """
-            INSERT INTO greetings_log (tg_user_id, greeting_text, sent_at)
-            VALUES (?, ?, ?)
-            """,
-            (tg_user_id, greeting_text, ts),
-        )
-        await self._conn.commit()
+        ts = await self._time_param(sent_at or utc_now())
+        await self._write([(INSERT_GREETING_SQL, (tg_user_id, greeting_id, ts))])
 
     async def add_message(
         self,
@@ -111,71 +1651,249 @@ class Database:
         raw_payload: Optional[str] = None,
         received_at: Optional[str] = None,
     ) -> None:
-        ts = received_at or utc_now()
-        await self._conn.execute(
-            """
-            INSERT INTO messages_log (tg_user_id, message_text, message_type, raw_payload, received_at)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (tg_user_id, message_text, message_type, raw_payload, ts),
+        ts = await self._time_param(received_at or utc_now())
+        await self._write(
+            [(INSERT_MESSAGE_SQL, (tg_user_id, message_text, message_type, raw_payload, ts))]
         )
-        await self._conn.commit()
 
-    async def list_users(self, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-        cursor = await self._conn.execute(
-            """
-            SELECT
-                u.*,
-                IFNULL(g.count, 0) AS greetings_count
-            FROM users u
-            LEFT JOIN (
-                SELECT tg_user_id, COUNT(*) AS count
-                FROM greetings_log
-                GROUP BY tg_user_id
-            ) g ON g.tg_user_id = u.tg_user_id
-            ORDER BY u.last_seen_at DESC
-            LIMIT ? OFFSET ?
-            """,
-            (limit, offset),
+    async def log_messages(self, rows: Sequence[Dict[str, Any]]) -> Optional[Set[int]]:
+        """Upsert the senders and insert the messages of ``rows`` in one transaction.
+
+        Each row has the ``upsert_user`` and ``add_message`` arguments; rows
+        with ``upsert=False`` only insert the message. Returns the ids of users
+        this batch created, or None in write-behind mode.
+        """
+        if not rows:
+            return set()
+        if await self._uses_epoch_ms():
+            times = [to_epoch_ms(row["received_at"]) for row in rows]
+        else:
+            times = [row["received_at"] for row in rows]
+        statements: List[Statement] = [
+            upsert_user_statement(
+                row["tg_user_id"], row["first_name"], row["last_name"], row["username"], ts
+            )
+            for row, ts in zip(rows, times)
+            if row.get("upsert", True)
+        ]
+        statements.extend(
+            (
+                INSERT_MESSAGE_SQL,
+                (
+                    row["tg_user_id"],
+                    row["message_text"],
+                    row["message_type"],
+                    row["raw_payload"],
+                    ts,
+                ),
+            )
+            for row, ts in zip(rows, times)
         )
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+        if self.write_behind:
+            await self._write(statements)
+            return None
+        user_ids = sorted({row["tg_user_id"] for row in rows})
+        async with self._write_lock:
+            try:
+                cursor = await self._conn.execute(
+                    "SELECT tg_user_id FROM users WHERE tg_user_id IN (%s)"
+                    % ",".join("?" * len(user_ids)),
+                    user_ids,
+                )
+                existing = {row[0] for row in await cursor.fetchall()}
+                await self._execute_statements(statements)
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+        return set(user_ids) - existing
 
-    async def get_user(self, tg_user_id: int) -> Optional[Dict[str, Any]]:
+    async def rebuild_rollups(self) -> None:
+        """Recompute the time-series rollups from the logs.
+
+        Buckets of messages already moved to the archive are recomputed
+        without them. Also completes the rollup backfills if they are still
+        running.
+        """
+        await self._write(
+            [(statement, ()) for statement in ROLLUP_BACKFILL]
+            + [
+                (
+                    "UPDATE backfill SET copied = target WHERE name IN (%s)"
+                    % ",".join("?" * len(ROLLUP_BACKFILLS)),
+                    tuple(ROLLUP_BACKFILLS),
+                )
+            ]
+        )
+        await self.flush()
+
+    async def prune_rollups(self, granularity: str, before: str) -> None:
+        """Drop ``granularity`` buckets that start before the ``before`` timestamp."""
+        bucket = before[: ROLLUP_GRANULARITIES[granularity]]
+        await self._write(
+            [
+                (
+                    "DELETE FROM stats_rollup WHERE granularity = ? AND bucket < ?",
+                    (granularity, bucket),
+                ),
+                (
+                    "DELETE FROM active_users_rollup WHERE granularity = ? AND bucket < ?",
+                    (granularity, bucket),
+                ),
+            ]
+        )
+        await self.flush()
+
+    async def rebuild_search_index(self) -> None:
+        """Re-index every message text, e.g. after restoring messages_log from a backup.
+
+        Also completes the "messages_fts" backfill if it is still running.
+        """
+        await self._write(
+            [
+                (REBUILD_MESSAGES_FTS_SQL, ()),
+                ("UPDATE backfill SET copied = target WHERE name = 'messages_fts'", ()),
+            ]
+        )
+        await self.flush()
+
+    async def optimize_search_index(self) -> None:
+        """Merge the index b-trees into one; worth running after large deletes."""
+        await self._write([("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')", ())])
+        await self.flush()
+
+    async def messages_before(self, cutoff: str, limit: int) -> List[Dict[str, Any]]:
+        """Oldest messages received before ``cutoff``, oldest first."""
         cursor = await self._conn.execute(
             """
-            SELECT
-                u.*,
-                IFNULL(g.count, 0) AS greetings_count
-            FROM users u
-            LEFT JOIN (
-                SELECT tg_user_id, COUNT(*) AS count
-                FROM greetings_log
-                GROUP BY tg_user_id
-            ) g ON g.tg_user_id = u.tg_user_id
-            WHERE u.tg_user_id = ?
+            SELECT id, tg_user_id, message_text, message_type, raw_payload, received_at
+            FROM messages_log
+            WHERE received_at < ?
+            ORDER BY received_at, id
+            LIMIT ?
             """,
-            (tg_user_id,),
+            (await self._time_param(cutoff), limit),
         )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        return [iso_times(row) for row in await cursor.fetchall()]
+
+    async def delete_messages(self, ids: Sequence[int]) -> None:
+        """Delete messages by id in one transaction; waits for write-behind to commit it.
+
+        Per-user counters in user_stats are lifetime totals and are not decremented.
+        """
+        if not ids:
+            return
+        await self._write([("DELETE FROM messages_log WHERE id = ?", (row_id,)) for row_id in ids])
+        await self.flush()
+
+    async def _decode_time_cursor(self, cursor: str) -> Tuple[Any, int]:
+        """:func:`decode_cursor` of a page sorted by a time column."""
+        sort_value, row_id = decode_cursor(cursor)
+        return await self._time_param(sort_value), row_id
+
+    async def list_users(
+        self, limit: int = 50, offset: int = 0, cursor: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Users by last activity, newest first.
+
+        With ``cursor`` (see :func:`next_cursor`) the page starts right after
+        the row the cursor points to and ``offset`` is ignored.
+        """
+        query = await self._user_select()
+        params: List[Any] = []
+        if cursor is not None:
+            query += " WHERE (u.last_seen_at, u.id) < (?, ?)"
+            params.extend(await self._decode_time_cursor(cursor))
+            offset = 0
+        query += " ORDER BY u.last_seen_at DESC, u.id DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+        async with self._reading() as conn:
+            result = await conn.execute(query, params)
+            rows = await result.fetchall()
+        return [iso_times(row) for row in rows]
+
+    async def _user_select(self) -> str:
+        """USER_SELECT, or its log-based form while the user_stats backfills run."""
+        if await self.backfill_pending(*USER_STATS_BACKFILLS):
+            return USER_SELECT_FROM_LOGS
+        return USER_SELECT
+
+    async def get_user(self, tg_user_id: int) -> Optional[Dict[str, Any]]:
+        async with self._reading() as conn:
+            cursor = await conn.execute(
+                await self._user_select() + " WHERE u.tg_user_id = ?", (tg_user_id,)
+            )
+            row = await cursor.fetchone()
+        return iso_times(row) if row else None
+
+    async def search_users(self, query: str, limit: int = 20) -> Optional[List[Dict[str, Any]]]:
+        """Users whose username, "first last" name or last name starts with ``query``.
+
+        Case-insensitive (see :func:`search_key`); a leading "@" is ignored
+        and a number also matches the ``tg_user_id``. The cost does not depend
+        on the number of users. Order: tg_user_id, exact username, username
+        prefix, name, last name, then alphabetical. None while the keys of
+        existing users are still being filled.
+        """
+        if await self.backfill_pending("user_search"):
+            return None
+        query = query.strip()
+        term = search_key(query.lstrip("@"))
+        if term is None:
+            return []
+        # isdigit() also accepts "²" and other digits int() rejects, and
+        # SQLite integers stop at 2**63 - 1.
+        numeric = query.isascii() and query.isdigit() and int(query) < 2**63
+        params = {
+            "term": term,
+            # Sorts after every key that starts with term.
+            "upper": term + "\U0010ffff",
+            "limit": limit,
+            "tg_user_id": int(query) if numeric else None,
+        }
+        sql = USER_SEARCH_SQL.replace(USER_SELECT, await self._user_select())
+        async with self._reading() as conn:
+            cursor = await conn.execute(sql, params)
+            rows = await cursor.fetchall()
+        return [iso_times(row) for row in rows]
 
     async def list_greetings(
-        self, limit: int = 50, offset: int = 0, tg_user_id: Optional[int] = None
+        self,
+        limit: int = 50,
+        offset: int = 0,
+        tg_user_id: Optional[int] = None,
+        cursor: Optional[str] = None,
     ) -> List[Dict[str, Any]]:
-        query = """
-            SELECT tg_user_id, greeting_text, sent_at
-            FROM greetings_log
+        query = f"""
+            SELECT l.id, l.tg_user_id, l.greeting_id, {await self._greeting_text_sql()} AS greeting_text,
+                l.sent_at
+            FROM greetings_log l
+            LEFT JOIN greetings g ON g.id = l.greeting_id
         """
+        clauses = []
         params: List[Any] = []
         if tg_user_id is not None:
-            query += " WHERE tg_user_id = ?"
+            clauses.append("l.tg_user_id = ?")
             params.append(tg_user_id)
-        query += " ORDER BY sent_at DESC LIMIT ? OFFSET ?"
+        if cursor is not None:
+            clauses.append("(l.sent_at, l.id) < (?, ?)")
+            params.extend(await self._decode_time_cursor(cursor))
+            offset = 0
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY l.sent_at DESC, l.id DESC LIMIT ? OFFSET ?"
         params.extend([limit, offset])
-        cursor = await self._conn.execute(query, params)
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+        async with self._reading() as conn:
+            result = await conn.execute(query, params)
+            rows = await result.fetchall()
+        return [iso_times(row) for row in rows]
+
+    async def _greeting_text_sql(self) -> str:
+        """Text of a greetings_log row ``l`` joined to its catalog entry ``g``."""
+        if await self.backfill_pending("greetings_catalog"):
+            # Rows the catalog backfill has not reached yet only have their old text.
+            return "IFNULL(g.text, l.greeting_text)"
+        return "g.text"
 
     async def list_messages(
         self,
@@ -183,9 +1901,10 @@ class Database:
         offset: int = 0,
         tg_user_id: Optional[int] = None,
         message_type: Optional[str] = None,
+        cursor: Optional[str] = None,
     ) -> List[Dict[str, Any]]:
         query = """
-            SELECT tg_user_id, message_text, message_type, raw_payload, received_at
+            SELECT id, tg_user_id, message_text, message_type, raw_payload, received_at
             FROM messages_log
         """
         clauses = []
@@ -196,44 +1915,352 @@ class Database:
         if message_type is not None:
             clauses.append("message_type = ?")
             params.append(message_type)
+        if cursor is not None:
+            clauses.append("(received_at, id) < (?, ?)")
+            params.extend(await self._decode_time_cursor(cursor))
+            offset = 0
         if clauses:
             query += " WHERE " + " AND ".join(clauses)
-        query += " ORDER BY received_at DESC LIMIT ? OFFSET ?"
+        query += " ORDER BY received_at DESC, id DESC LIMIT ? OFFSET ?"
         params.extend([limit, offset])
-        cursor = await self._conn.execute(query, params)
-        rows = await cursor.fetchall()
+        async with self._reading() as conn:
+            result = await conn.execute(query, params)
+            rows = await result.fetchall()
+        return [iso_times(row) for row in rows]
+
+    async def export_rows(
+        self,
+        kind: str,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        tg_user_id: Optional[int] = None,
+        chunk_size: int = 1000,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Yield every row of an :data:`EXPORT_QUERIES` table, oldest first.
+
+        Rows are read in keyset chunks of ``chunk_size``, each in its own short
+        read, so memory stays constant and no read transaction is held open
+        while the consumer is slow. ``since`` is inclusive, ``until`` exclusive.
+        """
+        select, time_column, alias = EXPORT_QUERIES[kind]
+        if kind == "greetings":
+            select = select.replace("g.text", await self._greeting_text_sql())
+        elif kind == "users":
+            select = await self._user_select()
+        column = f"{alias}.{time_column}"
+        since = await self._time_param(since) if since is not None else None
+        until = await self._time_param(until) if until is not None else None
+        after: Optional[Tuple[Any, int]] = None
+        while True:
+            clauses = []
+            params: List[Any] = []
+            if since is not None:
+                clauses.append(f"{column} >= ?")
+                params.append(since)
+            if until is not None:
+                clauses.append(f"{column} < ?")
+                params.append(until)
+            if tg_user_id is not None:
+                clauses.append(f"{alias}.tg_user_id = ?")
+                params.append(tg_user_id)
+            if after is not None:
+                clauses.append(f"({column}, {alias}.id) > (?, ?)")
+                params.extend(after)
+            query = select
+            if clauses:
+                query += " WHERE " + " AND ".join(clauses)
+            query += f" ORDER BY {column}, {alias}.id LIMIT ?"
+            params.append(chunk_size)
+            async with self._reading() as conn:
+                result = await conn.execute(query, params)
+                rows = await result.fetchall()
+            for row in rows:
+                yield iso_times(row)
+            if len(rows) < chunk_size:
+                return
+            after = (rows[-1][time_column], rows[-1]["id"])
+
+    async def search_messages(
+        self,
+        q: str,
+        limit: int = 50,
+        tg_user_id: Optional[int] = None,
+        message_type: Optional[str] = None,
+        cursor: Optional[str] = None,
+        order: str = "rank",
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Messages containing every word of ``q``, with a highlighted ``snippet``.
+
+        ``order="rank"`` sorts by bm25 relevance (``rank``, lower is better);
+        ``order="recent"`` sorts newest first and stays fast for words that
+        match millions of rows, since relevance is not computed for them all.
+        Page with :func:`next_cursor` on ``rank`` or ``id`` respectively.
+        Raises ValueError on an empty query or an invalid cursor. None until
+        the "messages_fts" backfill has indexed the older messages.
+        """
+        if order not in SEARCH_ORDERS:
+            raise ValueError(f"Unknown search order {order!r}, expected one of {SEARCH_ORDERS}.")
+        if await self.backfill_pending("messages_fts"):
+            return None
+        query = """
+            SELECT
+                m.id, m.tg_user_id, m.message_text, m.message_type, m.raw_payload, m.received_at,
+                messages_fts.rank AS rank,
+                snippet(messages_fts, 0, '<mark>', '</mark>', '…', 16) AS snippet
+            FROM messages_fts
+            JOIN messages_log m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        """
+        params: List[Any] = [fts_query(q)]
+        if tg_user_id is not None:
+            query += " AND m.tg_user_id = ?"
+            params.append(tg_user_id)
+        if message_type is not None:
+            query += " AND m.message_type = ?"
+            params.append(message_type)
+        after = decode_cursor(cursor) if cursor is not None else None
+        if order == "rank":
+            if after is not None:
+                query += " AND (messages_fts.rank, messages_fts.rowid) > (?, ?)"
+                params.extend(after)
+            query += " ORDER BY messages_fts.rank, messages_fts.rowid"
+        else:
+            if after is not None:
+                query += " AND messages_fts.rowid < ?"
+                params.append(after[1])
+            query += " ORDER BY messages_fts.rowid DESC"
+        query += " LIMIT ?"
+        params.append(limit)
+        async with self._reading() as conn:
+            result = await conn.execute(query, params)
+            rows = await result.fetchall()
+        return [iso_times(row) for row in rows]
+
+    async def _write_returning(self, sql: str, params: Sequence[Any]) -> List[Dict[str, Any]]:
+        """Run one statement that needs its RETURNING rows, bypassing write-behind."""
+        await self.flush()
+        async with self._write_lock:
+            try:
+                cursor = await self._conn.execute(sql, params)
+                rows = await cursor.fetchall()
+                await self._commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
         return [dict(row) for row in rows]
 
-    async def get_stats(self) -> Dict[str, Any]:
-        cursor = await self._conn.execute("SELECT COUNT(*) AS total_users FROM users")
-        total_users = (await cursor.fetchone())["total_users"]
+    async def create_broadcast(self, text: str) -> Dict[str, Any]:
+        """Queue a broadcast to every user known now."""
+        rows = await self._write_returning(
+            """
+            INSERT INTO broadcasts (text, created_at, max_user_id, total)
+            SELECT ?, ?, IFNULL(MAX(id), 0), COUNT(*) FROM users
+            RETURNING *
+            """,
+            (text, utc_now()),
+        )
+        return rows[0]
 
-        cursor = await self._conn.execute(
-            "SELECT COUNT(*) AS total_greetings FROM greetings_log"
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        async with self._reading() as conn:
+            cursor = await conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+            row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def list_broadcasts(self, limit: int = 50) -> List[Dict[str, Any]]:
+        async with self._reading() as conn:
+            cursor = await conn.execute(
+                "SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)
+            )
+            rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+
+    async def set_broadcast_status(
+        self, broadcast_id: int, status: str, from_statuses: Sequence[str]
+    ) -> Optional[Dict[str, Any]]:
+        """Move a broadcast to ``status`` if it is in one of ``from_statuses``."""
+        finished = status in ("done", "cancelled")
+        rows = await self._write_returning(
+            """
+            UPDATE broadcasts
+            SET status = ?, finished_at = CASE WHEN ? THEN ? ELSE finished_at END
+            WHERE id = ? AND status IN (%s)
+            RETURNING *
+            """
+            % ",".join("?" * len(from_statuses)),
+            (status, finished, utc_now(), broadcast_id, *from_statuses),
         )
-        total_greetings = (await cursor.fetchone())["total_greetings"]
+        return rows[0] if rows else None
 
-        cursor = await self._conn.execute(
-            "SELECT COUNT(*) AS total_messages FROM messages_log"
+    async def claim_broadcast(self, owner: str, stale_before: str) -> Optional[Dict[str, Any]]:
+        """Take the oldest pending broadcast, or a running one whose owner went silent."""
+        now = utc_now()
+        rows = await self._write_returning(
+            """
+            UPDATE broadcasts
+            SET status = 'running', owner = ?, heartbeat_at = ?,
+                started_at = COALESCE(started_at, ?)
+            WHERE id = (
+                SELECT id FROM broadcasts
+                WHERE status = 'pending' OR (status = 'running' AND heartbeat_at < ?)
+                ORDER BY id
+                LIMIT 1
+            )
+            RETURNING *
+            """,
+            (owner, now, now, stale_before),
         )
-        total_messages = (await cursor.fetchone())["total_messages"]
+        return rows[0] if rows else None
 
-        cursor = await self._conn.execute(
+    async def heartbeat_broadcast(self, broadcast_id: int, owner: str) -> Optional[str]:
+        """Refresh the lease; returns the current status, or None if ``owner`` lost it."""
+        rows = await self._write_returning(
             """
-            SELECT tg_user_id, COUNT(*) AS greetings_count
-            FROM greetings_log
-            GROUP BY tg_user_id
-            ORDER BY greetings_count DESC
-            LIMIT 10
+            UPDATE broadcasts SET heartbeat_at = ?
+            WHERE id = ? AND owner = ?
+            RETURNING status
+            """,
+            (utc_now(), broadcast_id, owner),
+        )
+        return rows[0]["status"] if rows else None
+
+    async def checkpoint_broadcast(
+        self,
+        broadcast_id: int,
+        owner: str,
+        last_user_id: int,
+        sent: int,
+        failed: int,
+        blocked: int,
+    ) -> Optional[Dict[str, Any]]:
+        """Record a handled chunk (counters are deltas); None if ``owner`` lost the lease."""
+        rows = await self._write_returning(
             """
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?,
+                heartbeat_at = ?
+            WHERE id = ? AND owner = ?
+            RETURNING *
+            """,
+            (last_user_id, sent, failed, blocked, utc_now(), broadcast_id, owner),
         )
-        top_users = [dict(row) for row in await cursor.fetchall()]
+        return rows[0] if rows else None
+
+    async def finish_broadcast(self, broadcast_id: int, owner: str) -> Optional[Dict[str, Any]]:
+        rows = await self._write_returning(
+            """
+            UPDATE broadcasts SET status = 'done', finished_at = ?
+            WHERE id = ? AND owner = ? AND status = 'running'
+            RETURNING *
+            """,
+            (utc_now(), broadcast_id, owner),
+        )
+        return rows[0] if rows else None
+
+    async def broadcast_recipients(
+        self, after_user_id: int, max_user_id: int, limit: int
+    ) -> List[Tuple[int, int]]:
+        """Next (users.id, tg_user_id) pairs of a broadcast in id order."""
+        async with self._reading() as conn:
+            cursor = await conn.execute(
+                """
+                SELECT id, tg_user_id FROM users
+                WHERE id > ? AND id <= ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (after_user_id, max_user_id, limit),
+            )
+            rows = await cursor.fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    async def get_rollups(
+        self,
+        granularity: str,
+        since: str,
+        until: str,
+        metrics: Optional[Sequence[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Rollup rows (bucket, metric, value) with ``since <= bucket < until``.
+
+        ``since``/``until`` are bucket names (ISO timestamp prefixes). With
+        ``metrics`` only those metrics are returned.
+        """
+        if granularity not in ROLLUP_GRANULARITIES:
+            raise ValueError(f"Unknown granularity {granularity!r}")
+        query = """
+            SELECT bucket, metric, value
+            FROM stats_rollup
+            WHERE granularity = ? AND bucket >= ? AND bucket < ?
+        """
+        params: List[Any] = [granularity, since, until]
+        if metrics:
+            query += " AND metric IN (%s)" % ",".join("?" * len(metrics))
+            params.extend(metrics)
+        query += " ORDER BY bucket"
+        async with self._reading() as conn:
+            result = await conn.execute(query, params)
+            rows = await result.fetchall()
+        return [dict(row) for row in rows]
+
+    async def rollups_pending(self) -> bool:
+        """True while the rollups do not include every row that predates them yet."""
+        return await self.backfill_pending(*ROLLUP_BACKFILLS)
+
+    async def get_stats(self, top_limit: int = 10) -> Dict[str, Any]:
+        # Until the user_stats backfills are done the per-user totals come from the logs.
+        stats = "user_stats"
+        if await self.backfill_pending(*USER_STATS_BACKFILLS):
+            stats = """(
+                SELECT tg_user_id, COUNT(*) AS greetings_count, 0 AS messages_count
+                FROM greetings_log GROUP BY tg_user_id
+                UNION ALL
+                SELECT tg_user_id, 0, COUNT(*) FROM messages_log GROUP BY tg_user_id
+            )"""
+        async with self._reading() as conn:
+            cursor = await conn.execute("SELECT COUNT(*) AS total_users FROM users")
+            total_users = (await cursor.fetchone())["total_users"]
+
+            cursor = await conn.execute(
+                "SELECT COUNT(*) AS total_greetings FROM greetings_log"
+            )
+            total_greetings = (await cursor.fetchone())["total_greetings"]
+
+            # Lifetime total: archived messages are gone from messages_log but
+            # still counted in user_stats.
+            cursor = await conn.execute(
+                f"SELECT IFNULL(SUM(messages_count), 0) AS total_messages FROM {stats}"
+            )
+            total_messages = (await cursor.fetchone())["total_messages"]
+
+            cursor = await conn.execute(
+                f"""
+                SELECT tg_user_id, greetings_count
+                FROM {stats}
+                WHERE greetings_count > 0
+                ORDER BY greetings_count DESC
+                LIMIT ?
+                """,
+                (top_limit,),
+            )
+            top_users = [dict(row) for row in await cursor.fetchall()]
+
+            cursor = await conn.execute(
+                """
+                SELECT id AS greeting_id, text, sent_count
+                FROM greetings
+                WHERE sent_count > 0
+                ORDER BY sent_count DESC
+                LIMIT ?
+                """,
+                (top_limit,),
+            )
+            top_greetings = [dict(row) for row in await cursor.fetchall()]
 
         return {
             "total_users": total_users,
             "total_greetings": total_greetings,
             "total_messages": total_messages,
             "top_users": top_users,
+            "top_greetings": top_greetings,
         }
-
-
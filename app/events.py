@@ -1,21 +1,161 @@
+import asyncio
 import logging
-from typing import Any, Dict
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
 
 import aiohttp
 
+from .metrics import REGISTRY
+
 logger = logging.getLogger(__name__)
 
+EVENTS_SENT = REGISTRY.counter("bot_events_sent_total", "Events delivered to the backend.")
+EVENTS_DROPPED = REGISTRY.counter(
+    "bot_events_dropped_total",
+    "Events given up on: buffer overflow, rejected by the backend or failed to send.",
+    ("reason",),
+)
+EVENT_POST_FAILURES = REGISTRY.counter(
+    "bot_event_post_failures_total", "Batch posts that failed and will be retried."
+)
+EVENT_POST_SECONDS = REGISTRY.histogram("bot_event_post_seconds", "Latency of batch posts.")
+
+
+class EventShipper:
+    """Ships bot events to the backend in the background.
+
+    ``emit`` never waits: events are buffered in a bounded queue and a single
+    sender task posts them in batches to ``/api/internal/events/batch`` over
+    one long-lived HTTP session. When the backend is unreachable the sender
+    retries with exponential backoff; if the buffer overflows meanwhile, the
+    oldest events are dropped.
+    """
+
+    def __init__(
+        self,
+        backend_url: str,
+        auth_secret: str,
+        queue_size: int = 10000,
+        batch_size: int = 200,
+        flush_interval: float = 0.05,
+        timeout: float = 5.0,
+        max_backoff: float = 30.0,
+    ) -> None:
+        self.url = f"{backend_url.rstrip('/')}/api/internal/events/batch"
+        self._headers = {"X-Auth-Secret": auth_secret}
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._queue_size = max(queue_size, 1)
+        self._batch_size = max(batch_size, 1)
+        self._flush_interval = flush_interval
+        self._timeout = timeout
+        self._max_backoff = max_backoff
+        self._wakeup = asyncio.Event()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed_posts = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue) + self._in_flight
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        self._queue.append(event)
+        self._trim()
+        self._wakeup.set()
+
+    def _trim(self) -> None:
+        while len(self._queue) > self._queue_size:
+            self._queue.popleft()
+            self.dropped += 1
+            EVENTS_DROPPED.inc(reason="overflow")
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self._timeout)
+            )
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, drain_timeout: float = 5.0) -> None:
+        """Try to deliver what is buffered, then stop the sender."""
+        if self._task is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_timeout
+        while self.pending and loop.time() < deadline and not self._task.done():
+            await asyncio.sleep(0.05)
+        if self.pending:
+            logger.warning("Dropping %s undelivered events on shutdown", self.pending)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Event sender had stopped with an error")
+        self._task = None
+        if self._session:
+            await self._session.close()
+            self._session = None
 
-async def send_event(backend_url: str, auth_secret: str, event: Dict[str, Any]) -> None:
-    """Send event to backend for websocket broadcast."""
-    url = f"{backend_url.rstrip('/')}/api/internal/events"
-    headers = {"X-Auth-Secret": auth_secret, "Content-Type": "application/json"}
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=event, headers=headers, timeout=5) as resp:
-                if resp.status >= 300:
-                    text = await resp.text()
-                    logger.warning("Failed to send event: %s %s", resp.status, text)
-    except Exception:
-        logger.exception("Failed to send event to backend")
+    async def _run(self) -> None:
+        backoff = 0.5
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                # Let events emitted by the same update join the batch.
+                await asyncio.sleep(self._flush_interval)
+            batch = [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+            self._in_flight = len(batch)
+            try:
+                delivered = await self._post(batch)
+            except Exception:
+                # Not an outage (those are retried): sending this batch again
+                # would most likely fail the same way, so it is given up on.
+                logger.exception("Dropping %s events that failed to send", len(batch))
+                self.dropped += len(batch)
+                EVENTS_DROPPED.inc(len(batch), reason="error")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+                continue
+            finally:
+                self._in_flight = 0
+            if delivered:
+                backoff = 0.5
+                continue
+            self.failed_posts += 1
+            EVENT_POST_FAILURES.inc()
+            self._queue.extendleft(reversed(batch))
+            self._trim()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self._max_backoff)
 
+    async def _post(self, batch: List[Dict[str, Any]]) -> bool:
+        """Return True when the batch is done with (delivered or rejected for good)."""
+        assert self._session is not None
+        started = time.perf_counter()
+        try:
+            async with self._session.post(
+                self.url, json={"events": batch}, headers=self._headers
+            ) as resp:
+                if resp.status < 300:
+                    self.sent += len(batch)
+                    EVENTS_SENT.inc(len(batch))
+                    return True
+                text = await resp.text()
+                if 400 <= resp.status < 500:
+                    logger.error("Backend rejected %s events: %s %s", len(batch), resp.status, text)
+                    self.dropped += len(batch)
+                    EVENTS_DROPPED.inc(len(batch), reason="rejected")
+                    return True
+                logger.warning("Failed to send events: %s %s", resp.status, text)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            logger.warning("Failed to send events to backend: %s", exc)
+        finally:
+            EVENT_POST_SECONDS.observe(time.perf_counter() - started)
+        return False
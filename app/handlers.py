@@ -1,23 +1,24 @@
 import logging
 
 import logging
-from typing import Optional
+from typing import Optional, Tuple
 
 from aiogram import Router
 from aiogram.filters import Command, CommandStart
 from aiogram.types import CallbackQuery, Message, User
 
 from .db import Database
-from .events import send_event
+from .events import EventShipper
 from .keyboards import get_start_kb
 from .texts import get_random_greeting
+from .user_cache import UserUpsertCache
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 db: Optional[Database] = None
-backend_url: Optional[str] = None
-backend_secret: Optional[str] = None
+shipper: Optional[EventShipper] = None
+user_cache: Optional[UserUpsertCache] = None
 
 
 def set_db(database: Database) -> None:
@@ -25,47 +26,71 @@ def set_db(database: Database) -> None:
     db = database
 
 
-def set_event_sender(url: str, secret: str) -> None:
-    global backend_url, backend_secret
-    backend_url = url
-    backend_secret = secret
+def set_event_shipper(event_shipper: EventShipper) -> None:
+    global shipper
+    shipper = event_shipper
+
+
+def set_user_cache(cache: UserUpsertCache) -> None:
+    global user_cache
+    user_cache = cache
 
 
 async def upsert_from_user(user: User) -> None:
     if not db:
         logger.warning("Database is not initialized; cannot upsert user.")
         return
-    await db.upsert_user(
+    if user_cache is not None and not user_cache.check(
+        user.id, user.first_name, user.last_name, user.username
+    ):
+        return
+    created, changed = await db.upsert_user(
         tg_user_id=user.id,
         first_name=user.first_name,
         last_name=user.last_name,
         username=user.username,
         seen_at=None,
     )
-    if backend_url and backend_secret:
-        await send_event(
-            backend_url,
-            backend_secret,
+    if user_cache is not None:
+        user_cache.remember(user.id, user.first_name, user.last_name, user.username)
+    if shipper and (changed or created):
+        shipper.emit(
             {
                 "type": "user_upserted",
                 "user_id": user.id,
                 "first_name": user.first_name,
                 "last_name": user.last_name,
                 "username": user.username,
-            },
+                "is_new": created,
+            }
         )
 
 
-async def log_greeting(user: User, greeting: str) -> None:
+async def pick_greeting(user: User) -> Tuple[Optional[int], str]:
+    """Next greeting from the user's rotation; a random uncatalogued one without a database."""
+    if db:
+        picked = await db.next_greeting(user.id)
+        if picked:
+            return picked
+    return None, get_random_greeting()
+
+
+async def log_greeting(user: User, greeting_id: Optional[int], greeting: str) -> None:
     if not db:
         logger.warning("Database is not initialized; cannot log greeting.")
         return
-    await db.add_greeting(tg_user_id=user.id, greeting_text=greeting)
-    if backend_url and backend_secret:
-        await send_event(
-            backend_url,
-            backend_secret,
-            {"type": "greeting_sent", "user_id": user.id, "text": greeting},
+    if greeting_id is None:
+        logger.warning("Greeting is not in the catalog; not logging it.")
+        return
+    await db.add_greeting(tg_user_id=user.id, greeting_id=greeting_id)
+    if shipper:
+        shipper.emit(
+            {
+                "type": "greeting_sent",
+                "user_id": user.id,
+                "greeting_id": greeting_id,
+                "text": greeting,
+            }
         )
 
 
@@ -84,10 +109,10 @@ async def handle_start(message: Message) -> None:
 async def handle_greeting(callback: CallbackQuery) -> None:
     if callback.from_user:
         await upsert_from_user(callback.from_user)
-    greeting = get_random_greeting()
+    greeting_id, greeting = await pick_greeting(callback.from_user)
     logger.info("Sending random greeting to user_id=%s", callback.from_user.id)
     if callback.from_user:
-        await log_greeting(callback.from_user, greeting)
+        await log_greeting(callback.from_user, greeting_id, greeting)
     if callback.message:
         await callback.message.answer(greeting)
     await callback.answer()
@@ -103,9 +128,9 @@ async def handle_info(message: Message) -> None:
 
 @router.message(Command("greet"))
 async def handle_greet(message: Message) -> None:
-    greeting = get_random_greeting()
+    greeting_id, greeting = await pick_greeting(message.from_user)
     logger.info("Sending random greeting to user_id=%s", message.from_user.id)
-    await log_greeting(message.from_user, greeting)
+    await log_greeting(message.from_user, greeting_id, greeting)
     await message.answer(greeting)
 
 
@@ -4,30 +4,109 @@ import logging
 from aiogram import Bot, Dispatcher
 
 from .commands import set_bot_commands
-from .config import load_settings
+from .config import settings_provider
 from .db import Database
-from .handlers import router, set_db, set_event_sender
-from .middleware import MessageLoggingMiddleware
+from .events import EventShipper
+from .handlers import router, set_db, set_event_shipper, set_user_cache
+from .message_log import MessageLogPipeline
+from .metrics import REGISTRY, start_metrics_server
+from .middleware import HandlerMetricsMiddleware, MessageLoggingMiddleware
+from .texts import GREETINGS
+from .user_cache import UserUpsertCache
+from .webhook import run_webhook
+
+
+def register_metrics(
+    db: Database, pipeline: MessageLogPipeline, shipper: EventShipper, user_cache: UserUpsertCache
+) -> None:
+    REGISTRY.collector("db_commits_total", "SQLite commits.", lambda: db.commits, kind="counter")
+    REGISTRY.collector("db_write_queue_depth", "Writes waiting for group commit.", lambda: db.queue_depth)
+    REGISTRY.collector("bot_message_log_queue_depth", "Messages waiting to be logged.", lambda: pipeline.depth)
+    REGISTRY.collector(
+        "bot_message_log_total",
+        "Incoming messages by outcome.",
+        lambda: {
+            ("persisted",): pipeline.persisted,
+            ("dropped",): pipeline.dropped,
+            ("failed",): pipeline.failed,
+        },
+        labelnames=("outcome",),
+        kind="counter",
+    )
+    REGISTRY.collector("bot_events_pending", "Events buffered for the backend.", lambda: shipper.pending)
+    REGISTRY.collector("bot_user_cache_size", "Users in the upsert cache.", lambda: len(user_cache))
 
 
 async def main() -> None:
     logging.basicConfig(level=logging.INFO)
-    settings = load_settings()
+    settings = settings_provider.get()
+    settings_provider.install_sighup_handler()
+    if settings.bot_mode not in ("polling", "webhook"):
+        raise ValueError(f"BOT_MODE must be 'polling' or 'webhook', got {settings.bot_mode!r}.")
     bot = Bot(token=settings.bot_token)
     dp = Dispatcher()
     dp.include_router(router)
 
-    db = await Database.create(settings.db_path)
+    db = await Database.create(
+        settings.db_path,
+        mode=settings.db_mode,
+        write_behind=settings.db_write_behind,
+        flush_interval_ms=settings.db_flush_interval_ms,
+        flush_max_rows=settings.db_flush_max_rows,
+        write_queue_size=settings.db_write_queue_size,
+        flush_on_close=settings.db_flush_on_close,
+    )
+    await db.sync_greetings(GREETINGS)
     set_db(db)
-    set_event_sender(settings.backend_url, settings.auth_secret)
-    dp.message.middleware(
-        MessageLoggingMiddleware(db, backend_url=settings.backend_url, backend_secret=settings.auth_secret)
+    shipper = EventShipper(
+        settings.backend_url,
+        settings.auth_secret,
+        queue_size=settings.events_queue_size,
+        batch_size=settings.events_batch_size,
+    )
+    await shipper.start()
+    set_event_shipper(shipper)
+    user_cache = UserUpsertCache(
+        max_size=settings.user_cache_size, seen_window=settings.user_seen_window
+    )
+    set_user_cache(user_cache)
+    pipeline = MessageLogPipeline(
+        db,
+        shipper=shipper,
+        queue_size=settings.log_queue_size,
+        workers=settings.log_workers,
+        batch_size=settings.log_batch_size,
+        policy=settings.log_backpressure,
+        user_cache=user_cache,
     )
+    pipeline.start()
+    dp.message.middleware(MessageLoggingMiddleware(pipeline))
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    register_metrics(db, pipeline, shipper, user_cache)
+    metrics_server = None
+    if settings.metrics_port:
+        metrics_server = await start_metrics_server(settings.metrics_host, settings.metrics_port)
+        logging.info("Metrics on http://%s:%s/metrics", settings.metrics_host, settings.metrics_port)
 
-    logging.info("Setting bot commands...")
-    await set_bot_commands(bot)
-    logging.info("Starting polling...")
-    await dp.start_polling(bot)
+    try:
+        logging.info("Setting bot commands...")
+        try:
+            await set_bot_commands(bot)
+        except Exception:
+            logging.exception("Failed to set bot commands; continuing without them")
+        if settings.bot_mode == "webhook":
+            logging.info("Starting webhook server...")
+            await run_webhook(dp, bot, settings)
+        else:
+            logging.info("Starting polling...")
+            await dp.start_polling(bot)
+    finally:
+        if metrics_server:
+            await metrics_server.cleanup()
+        await pipeline.stop(timeout=settings.log_drain_timeout)
+        await shipper.close()
+        await db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+"""Database maintenance commands: python -m app.maintenance <command>."""
+import argparse
+import asyncio
+import logging
+
+from .config import get_settings
+from .db import Database
+
+COMMANDS = {
+    "rebuild-search": ("rebuild the full-text index of message texts", Database.rebuild_search_index),
+    "optimize-search": ("merge the full-text index into one b-tree", Database.optimize_search_index),
+    "rebuild-rollups": ("recompute the time-series rollups from the logs", Database.rebuild_rollups),
+    "rebuild-user-stats": ("recompute per-user counters from the logs", Database.rebuild_user_stats),
+    "finish-migrations": (
+        "run the backfills and the epoch-millisecond switch without stopping the bot",
+        Database.finish_migrations,
+    ),
+}
+
+
+async def _run(command: str) -> None:
+    settings = get_settings()
+    db = await Database.create(settings.db_path, mode=settings.db_mode)
+    try:
+        await COMMANDS[command][1](db)
+        await db.flush()
+    finally:
+        await db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, (help_text, _) in COMMANDS.items():
+        sub.add_parser(name, help=help_text)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(args.command))
+    print(f"{args.command}: done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+from .db import Database
+from .events import EventShipper
+from .metrics import REGISTRY
+from .user_cache import UserUpsertCache
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+# Number of recent enqueue-to-persist lags kept for percentiles.
+LAG_WINDOW = 1000
+
+LOG_LAG_SECONDS = REGISTRY.histogram(
+    "bot_message_log_lag_seconds", "Time from a message's arrival to its commit."
+)
+
+
+@dataclass
+class MessageRecord:
+    tg_user_id: int
+    first_name: Optional[str]
+    last_name: Optional[str]
+    username: Optional[str]
+    message_text: Optional[str]
+    message_type: str
+    raw_payload: Optional[str]
+    received_at: str
+    enqueued_at: float = field(default_factory=time.monotonic)
+    upsert: bool = True
+
+
+class MessageLogPipeline:
+    """Persists incoming messages off the reply path.
+
+    ``submit`` puts a record on a bounded queue; worker tasks drain it in
+    batches of up to ``batch_size`` records, write each batch in one
+    transaction and then emit ``message_received`` events. When the queue is
+    full, ``policy`` decides: ``block`` makes the submitter wait,
+    ``drop_newest`` discards the new record, ``drop_oldest`` discards the
+    oldest queued one.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        shipper: Optional[EventShipper] = None,
+        queue_size: int = 10000,
+        workers: int = 2,
+        batch_size: int = 100,
+        policy: str = "block",
+        user_cache: Optional[UserUpsertCache] = None,
+    ) -> None:
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(
+                f"Unknown backpressure policy {policy!r}, expected one of {BACKPRESSURE_POLICIES}."
+            )
+        self.db = db
+        self.shipper = shipper
+        self.user_cache = user_cache
+        self.policy = policy
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(queue_size, 1))
+        self._workers_count = max(workers, 1)
+        self._batch_size = max(batch_size, 1)
+        self._workers: List[asyncio.Task] = []
+        self._lags: Deque[float] = deque(maxlen=LAG_WINDOW)
+        self.persisted = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lag_max = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, record: MessageRecord) -> None:
+        if self.policy == "block":
+            await self._queue.put(record)
+            return
+        if self._queue.full():
+            self.dropped += 1
+            if self.policy == "drop_newest":
+                return
+            self._queue.get_nowait()
+            self._queue.task_done()
+        self._queue.put_nowait(record)
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._work()) for _ in range(self._workers_count)
+            ]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Persist what is queued (up to ``timeout`` seconds), then stop the workers."""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %s unlogged messages on shutdown", self.depth)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self._batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._persist(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _persist(self, batch: List[MessageRecord]) -> None:
+        if self.user_cache is not None:
+            self._coalesce_upserts(batch)
+        try:
+            created = await self.db.log_messages([asdict(record) for record in batch])
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("Failed to log %s incoming messages", len(batch))
+            return
+        if self.user_cache is not None:
+            for record in batch:
+                if record.upsert:
+                    self.user_cache.remember(
+                        record.tg_user_id, record.first_name, record.last_name, record.username
+                    )
+        now = time.monotonic()
+        for record in batch:
+            lag = now - record.enqueued_at
+            LOG_LAG_SECONDS.observe(lag)
+            self._lags.append(lag)
+            self.lag_max = max(self.lag_max, lag)
+        self.persisted += len(batch)
+        if self.shipper:
+            for record in batch:
+                self.shipper.emit(
+                    {
+                        "type": "message_received",
+                        "user_id": record.tg_user_id,
+                        "message_type": record.message_type,
+                        "message_text": record.message_text,
+                        "is_new_user": None if created is None else record.tg_user_id in created,
+                    }
+                )
+                if created:
+                    created.discard(record.tg_user_id)
+
+    def _coalesce_upserts(self, batch: List[MessageRecord]) -> None:
+        # Only the latest record per user may refresh the user row, and only
+        # if the cache says the row is out of date.
+        latest: Dict[int, MessageRecord] = {}
+        for record in batch:
+            record.upsert = False
+            latest[record.tg_user_id] = record
+        assert self.user_cache is not None
+        for record in latest.values():
+            record.upsert = self.user_cache.check(
+                record.tg_user_id, record.first_name, record.last_name, record.username
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        lags = sorted(self._lags)
+
+        def percentile(q: float) -> Optional[float]:
+            if not lags:
+                return None
+            return round(lags[min(len(lags) - 1, int(q * len(lags)))] * 1000, 3)
+
+        return {
+            "depth": self.depth,
+            "persisted": self.persisted,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "lag_p50_ms": percentile(0.5),
+            "lag_p95_ms": percentile(0.95),
+            "lag_max_ms": round(self.lag_max * 1000, 3),
+        }
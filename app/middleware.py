@@ -1,15 +1,27 @@
 import json
 import logging
+import time
 from typing import Any, Callable, Dict, Awaitable
 
 from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import Message, TelegramObject
 
-from .db import Database, utc_now
-from .events import send_event
+from .db import utc_now
+from .message_log import MessageLogPipeline, MessageRecord
+from .metrics import REGISTRY
 
 logger = logging.getLogger(__name__)
 
+MIDDLEWARE_SECONDS = REGISTRY.histogram(
+    "bot_log_middleware_seconds", "Time MessageLoggingMiddleware adds before the handler runs."
+)
+HANDLER_SECONDS = REGISTRY.histogram(
+    "bot_handler_seconds", "Handler latency, including Telegram API calls.", ("handler",)
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Handler calls that raised.", ("handler",)
+)
+
 
 def extract_message_payload(message: Message) -> Dict[str, Any]:
     return {
@@ -28,11 +40,11 @@ def get_message_type(message: Message) -> str:
 
 
 class MessageLoggingMiddleware(BaseMiddleware):
-    def __init__(self, db: Database, backend_url: str | None = None, backend_secret: str | None = None) -> None:
+    """Captures each incoming message for the log pipeline, then runs the handler."""
+
+    def __init__(self, pipeline: MessageLogPipeline) -> None:
         super().__init__()
-        self.db = db
-        self.backend_url = backend_url
-        self.backend_secret = backend_secret
+        self.pipeline = pipeline
 
     async def __call__(
         self,
@@ -40,35 +52,44 @@ class MessageLoggingMiddleware(BaseMiddleware):
         event: Message,
         data: Dict[str, Any],
     ) -> Any:
+        started = time.perf_counter()
         user = event.from_user
         if user:
             try:
-                await self.db.upsert_user(
-                    tg_user_id=user.id,
-                    first_name=user.first_name,
-                    last_name=user.last_name,
-                    username=user.username,
-                    seen_at=utc_now(),
-                )
-                await self.db.add_message(
-                    tg_user_id=user.id,
-                    message_text=get_message_text(event),
-                    message_type=get_message_type(event),
-                    raw_payload=json.dumps(extract_message_payload(event)),
-                    received_at=utc_now(),
-                )
-                if self.backend_url and self.backend_secret:
-                    await send_event(
-                        self.backend_url,
-                        self.backend_secret,
-                        {
-                            "type": "message_received",
-                            "user_id": user.id,
-                            "message_type": get_message_type(event),
-                            "message_text": get_message_text(event),
-                        },
+                await self.pipeline.submit(
+                    MessageRecord(
+                        tg_user_id=user.id,
+                        first_name=user.first_name,
+                        last_name=user.last_name,
+                        username=user.username,
+                        message_text=get_message_text(event),
+                        message_type=get_message_type(event),
+                        raw_payload=json.dumps(extract_message_payload(event)),
+                        received_at=utc_now(),
                     )
+                )
             except Exception:
                 logger.exception("Failed to log incoming message for user_id=%s", user.id)
+        MIDDLEWARE_SECONDS.observe(time.perf_counter() - started)
         return await handler(event, data)
 
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Times each handler call; register it after the other middlewares."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
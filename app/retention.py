@@ -0,0 +1,306 @@
+"""Retention for messages_log: move old messages into compressed day shards.
+
+Run ``python -m app.retention`` for a one-off pass, or set RETENTION_DAYS for
+the backend to run it periodically.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .db import ISO_FORMAT, Database, decode_cursor
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SHARD_SUFFIX = ".ndjson.gz"
+
+# (received_at, id) keys and rows of a day shard, oldest first.
+DayRows = Tuple[List[Tuple[str, int]], List[Dict[str, Any]]]
+
+
+class MessageArchive:
+    """Archived messages as gzip NDJSON files, one per UTC day of ``received_at``.
+
+    Batches are appended as separate gzip members. A pass interrupted between
+    writing a batch and deleting it from the database archives those rows
+    again on the next pass, so readers drop duplicate ids.
+
+    A shard can only be read from the start, and pages run newest first, so
+    the sorted rows of the last ``cached_days`` days read are kept until their
+    shard changes; paging through a day then decompresses it once.
+    """
+
+    def __init__(self, directory: str, cached_days: int = 2) -> None:
+        self.directory = Path(directory)
+        self.cached_days = max(cached_days, 1)
+        # day -> (shard size and mtime, its rows)
+        self._days: "OrderedDict[str, Tuple[Tuple[int, int], DayRows]]" = OrderedDict()
+        self._days_lock = threading.Lock()
+
+    def shard_path(self, day: str) -> Path:
+        return self.directory / f"messages-{day}{SHARD_SUFFIX}"
+
+    def append(self, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Append rows to their day shards and fsync them; returns rows written per day."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        written: Dict[str, int] = {}
+        for day, group in groupby(rows, key=lambda row: row["received_at"][:10]):
+            lines = [json.dumps(row, ensure_ascii=False) + "\n" for row in group]
+            with open(self.shard_path(day), "ab") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="ab") as shard:
+                    shard.write("".join(lines).encode())
+                raw.flush()
+                os.fsync(raw.fileno())
+            written[day] = written.get(day, 0) + len(lines)
+        return written
+
+    def days(self) -> List[Dict[str, Any]]:
+        if not self.directory.is_dir():
+            return []
+        shards = sorted(self.directory.glob(f"messages-*{SHARD_SUFFIX}"))
+        return [
+            {"day": path.name[len("messages-") : -len(SHARD_SUFFIX)], "bytes": path.stat().st_size}
+            for path in shards
+        ]
+
+    def read_day(self, day: str) -> List[Dict[str, Any]]:
+        """All messages of one day, newest first."""
+        return [dict(row) for row in reversed(self._read_day(day)[1])]
+
+    def _read_day(self, day: str) -> DayRows:
+        """Rows of one day (shared with the cache, not to be modified)."""
+        path = self.shard_path(day)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return [], []
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self._days_lock:
+            cached = self._days.get(day)
+            if cached is not None and cached[0] == version:
+                self._days.move_to_end(day)
+                return cached[1]
+        by_id: Dict[int, Dict[str, Any]] = {}
+        with gzip.open(path, "rt", encoding="utf-8") as shard:
+            for line in shard:
+                row = json.loads(line)
+                by_id[row["id"]] = row
+        rows = sorted(by_id.values(), key=lambda row: (row["received_at"], row["id"]))
+        keys = [(row["received_at"], row["id"]) for row in rows]
+        with self._days_lock:
+            self._days[day] = (version, (keys, rows))
+            self._days.move_to_end(day)
+            while len(self._days) > self.cached_days:
+                self._days.popitem(last=False)
+        return keys, rows
+
+    def query(
+        self,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        tg_user_id: Optional[int] = None,
+        message_type: Optional[str] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Archived messages between two days (inclusive), newest first.
+
+        Pages the same way as :meth:`Database.list_messages`; raises
+        ValueError on an invalid cursor.
+        """
+        after = decode_cursor(cursor) if cursor is not None else None
+        if after is not None and not isinstance(after[0], str):
+            raise ValueError("invalid cursor")
+        items: List[Dict[str, Any]] = []
+        for day in reversed([entry["day"] for entry in self.days()]):
+            if (date_to and day > date_to) or (date_from and day < date_from):
+                continue
+            if after is not None and day > after[0][:10]:
+                continue
+            keys, rows = self._read_day(day)
+            # Rows before the cursor, newest first.
+            end = bisect_left(keys, tuple(after)) if after is not None else len(rows)
+            for index in range(end - 1, -1, -1):
+                row = rows[index]
+                if tg_user_id is not None and row["tg_user_id"] != tg_user_id:
+                    continue
+                if message_type is not None and row["message_type"] != message_type:
+                    continue
+                items.append(dict(row))
+                if len(items) >= limit:
+                    return items
+        return items
+
+    @contextmanager
+    def exclusive(self) -> Iterator[bool]:
+        """Hold the archive lock if no other process does; yields whether it was taken."""
+        if fcntl is None:
+            yield True
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / ".lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class RetentionRunner:
+    """Moves messages older than ``retention_days`` from messages_log to the archive.
+
+    Rows go in batches of ``batch_size``: each batch is written and fsynced
+    to its shards before it is deleted in a short transaction of its own,
+    so the bot's writes interleave with a long pass. After the pass up to
+    ``vacuum_pages`` free pages are returned to the OS with incremental
+    vacuum, and minute rollup buckets older than ``rollup_minute_days`` are
+    dropped. Only one process runs a pass at a time (see
+    :meth:`MessageArchive.exclusive`).
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        archive: MessageArchive,
+        retention_days: int,
+        batch_size: int = 500,
+        interval: float = 3600.0,
+        vacuum_pages: int = 1000,
+        rollup_minute_days: int = 0,
+        pause: float = 0.05,
+    ) -> None:
+        self.db = db
+        self.archive = archive
+        self.retention_days = retention_days
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.rollup_minute_days = rollup_minute_days
+        self.pause = pause
+        self._task: Optional[asyncio.Task] = None
+
+    def cutoff(self, days: Optional[int] = None) -> str:
+        days = self.retention_days if days is None else days
+        moment = datetime.now(tz=timezone.utc) - timedelta(days=days)
+        return moment.strftime(ISO_FORMAT)
+
+    async def run_once(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"archived": 0, "days": {}, "vacuumed_pages": 0, "skipped": False}
+        with self.archive.exclusive() as acquired:
+            if not acquired:
+                logger.info("Another process is running retention; skipping this pass")
+                result["skipped"] = True
+                return result
+            cutoff = self.cutoff()
+            while True:
+                rows = await self.db.messages_before(cutoff, self.batch_size)
+                if not rows:
+                    break
+                written = await asyncio.to_thread(self.archive.append, rows)
+                await self.db.delete_messages([row["id"] for row in rows])
+                result["archived"] += len(rows)
+                for day, count in written.items():
+                    result["days"][day] = result["days"].get(day, 0) + count
+                if len(rows) < self.batch_size:
+                    break
+                await asyncio.sleep(self.pause)
+            if self.rollup_minute_days > 0:
+                await self.db.prune_rollups("minute", self.cutoff(self.rollup_minute_days))
+            if self.vacuum_pages > 0:
+                if await self.db.auto_vacuum_mode() == 2:
+                    result["vacuumed_pages"] = await self.db.incremental_vacuum(self.vacuum_pages)
+                elif result["archived"]:
+                    logger.info(
+                        "Incremental vacuum is off for this database; run "
+                        "`python -m app.retention --enable-incremental-vacuum` once to shrink it"
+                    )
+        if result["archived"]:
+            logger.info(
+                "Archived %s messages older than %s into %s day shards",
+                result["archived"],
+                cutoff,
+                len(result["days"]),
+            )
+        return result
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Retention pass failed")
+            await asyncio.sleep(self.interval)
+
+
+async def _run(args: argparse.Namespace) -> None:
+    from .config import get_settings
+
+    settings = get_settings()
+    db = await Database.create(settings.db_path, mode=settings.db_mode)
+    try:
+        if args.enable_incremental_vacuum:
+            await db.enable_incremental_vacuum()
+            print("auto_vacuum = incremental")
+        if args.days is None and settings.retention_days <= 0:
+            return
+        runner = RetentionRunner(
+            db,
+            MessageArchive(args.archive_dir or settings.archive_dir),
+            retention_days=args.days if args.days is not None else settings.retention_days,
+            batch_size=args.batch_size or settings.retention_batch_size,
+            vacuum_pages=settings.retention_vacuum_pages,
+            rollup_minute_days=settings.rollup_minute_days,
+        )
+        print(json.dumps(await runner.run_once()))
+    finally:
+        await db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, help="archive messages older than this (default: RETENTION_DAYS)")
+    parser.add_argument("--archive-dir", help="default: ARCHIVE_DIR")
+    parser.add_argument("--batch-size", type=int, help="default: RETENTION_BATCH_SIZE")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="convert the database to incremental auto-vacuum first (full VACUUM, stop the bot)",
+    )
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import random
-from typing import List
+import zlib
+from typing import List, Optional, Sequence, Tuple
 
 GREETINGS: List[str] = [
     "С Новым годом! Пусть наступающий год принесет радость и успех.",
@@ -25,3 +26,36 @@ def get_random_greeting() -> str:
     return random.choice(GREETINGS)
 
 
+def catalog_version(greeting_ids: Sequence[int]) -> int:
+    """Checksum of the active catalog; a change restarts every user's rotation."""
+    return zlib.crc32(",".join(map(str, sorted(greeting_ids))).encode())
+
+
+def shuffle_bag(greeting_ids: Sequence[int], seed: int) -> List[int]:
+    bag = sorted(greeting_ids)
+    random.Random(seed).shuffle(bag)
+    return bag
+
+
+def next_in_rotation(
+    greeting_ids: Sequence[int], state: Optional[Tuple[int, int, int]]
+) -> Tuple[int, Tuple[int, int, int]]:
+    """Pick the next greeting for a user and return it with the new state.
+
+    ``state`` is ``(seed, position, catalog_version)``: the user walks through
+    a seeded shuffle of the catalog, so nothing repeats until every greeting
+    was sent once. A new bag never starts with the greeting that ended the
+    previous one.
+    """
+    version = catalog_version(greeting_ids)
+    previous = None
+    if state is not None and state[2] == version:
+        seed, position, _ = state
+        if position < len(greeting_ids):
+            return shuffle_bag(greeting_ids, seed)[position], (seed, position + 1, version)
+        previous = shuffle_bag(greeting_ids, seed)[-1]
+    while True:
+        seed = random.getrandbits(31)
+        bag = shuffle_bag(greeting_ids, seed)
+        if bag[0] != previous or len(bag) == 1:
+            return bag[0], (seed, 1, version)
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+Profile = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+class UserUpsertCache:
+    """LRU of the last profile written per ``tg_user_id``.
+
+    Lets callers skip ``upsert_user`` when the profile fields are unchanged
+    and ``last_seen_at`` was written less than ``seen_window`` seconds ago, so
+    ``last_seen_at`` is refreshed at most once per window per user.
+    """
+
+    def __init__(self, max_size: int = 100000, seen_window: float = 60.0) -> None:
+        self.max_size = max(max_size, 1)
+        self.seen_window = seen_window
+        self._entries: "OrderedDict[int, Tuple[Profile, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def check(
+        self,
+        tg_user_id: int,
+        first_name: Optional[str],
+        last_name: Optional[str],
+        username: Optional[str],
+    ) -> bool:
+        """Return True when this sighting of the user needs an upsert.
+
+        That is when the user is not cached, the profile differs from the
+        cached one or ``last_seen_at`` is older than ``seen_window``.
+        """
+        entry = self._entries.get(tg_user_id)
+        if entry is None:
+            self.misses += 1
+            return True
+        self._entries.move_to_end(tg_user_id)
+        profile, written_at = entry
+        write = (
+            profile != (first_name, last_name, username)
+            or time.monotonic() - written_at >= self.seen_window
+        )
+        if not write:
+            self.hits += 1
+        return write
+
+    def remember(
+        self,
+        tg_user_id: int,
+        first_name: Optional[str],
+        last_name: Optional[str],
+        username: Optional[str],
+    ) -> None:
+        """Record that the user row was just written with this profile."""
+        self._entries[tg_user_id] = ((first_name, last_name, username), time.monotonic())
+        self._entries.move_to_end(tg_user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import secrets
+import signal
+from typing import Any, Set
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    """Accepts Telegram webhook calls and processes updates in the background.
+
+    The request is answered as soon as the update is parsed; the dispatcher
+    runs afterwards. When ``max_concurrency`` updates are already in flight
+    the call is answered with 503 so Telegram redelivers it later.
+    """
+
+    def __init__(
+        self, dp: Dispatcher, bot: Bot, secret_token: str, max_concurrency: int = 100
+    ) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.secret_token = secret_token
+        self.max_concurrency = max(max_concurrency, 1)
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # compare_digest() rejects non-ASCII str; aiohttp decodes headers
+        # with surrogateescape, which maps them back to the bytes received.
+        token = request.headers.get(SECRET_HEADER, "").encode("utf-8", "surrogateescape")
+        if not secrets.compare_digest(token, self.secret_token.encode()):
+            return web.Response(status=401, text="unauthorized")
+        if self.in_flight >= self.max_concurrency:
+            logger.warning("Webhook is at %s in-flight updates; asking Telegram to retry", self.in_flight)
+            return web.Response(status=503, text="busy")
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="invalid_json")
+        if not isinstance(update, dict):
+            return web.Response(status=400, text="invalid_update")
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({"ok": True})
+
+    async def _process(self, update: dict[str, Any]) -> None:
+        try:
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            logger.exception("Failed to process webhook update %s", update.get("update_id"))
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def make_app(self, path: str) -> web.Application:
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, settings: Settings) -> None:
+    if not settings.webhook_secret:
+        raise ValueError("WEBHOOK_SECRET must be set when BOT_MODE=webhook.")
+    handler = WebhookHandler(
+        dp, bot, settings.webhook_secret, max_concurrency=settings.webhook_max_concurrency
+    )
+    runner = web.AppRunner(handler.make_app(settings.webhook_path))
+    await runner.setup()
+    site = web.TCPSite(runner, settings.webhook_host, settings.webhook_port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await dp.emit_startup(bot=bot)
+    try:
+        await site.start()
+        logging.info(
+            "Webhook server listening on %s:%s%s",
+            settings.webhook_host,
+            settings.webhook_port,
+            settings.webhook_path,
+        )
+        if settings.webhook_url:
+            await bot.set_webhook(
+                settings.webhook_url,
+                secret_token=settings.webhook_secret,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logging.info("Webhook registered at %s", settings.webhook_url)
+        else:
+            logging.info("WEBHOOK_URL is empty; not registering the webhook with Telegram")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await handler.drain()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
@@ -7,7 +7,7 @@ from typing import Optional
 
 from fastapi import Depends, HTTPException, Request, Response, status
 
-from app.config import load_settings
+from app.config import Settings, settings_provider
 
 SESSION_COOKIE = "session_token"
 SESSION_TTL_HOURS = 24
@@ -53,8 +53,9 @@ def clear_session_cookie(response: Response) -> None:
     response.delete_cookie(SESSION_COOKIE)
 
 
-def get_settings():
-    return load_settings()
+async def get_settings() -> Settings:
+    # Async so FastAPI calls it on the event loop instead of a worker thread.
+    return settings_provider.get()
 
 
 def require_auth(request: Request, settings=Depends(get_settings)) -> str:
@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from app.db import ISO_FORMAT, Database
+from app.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_MESSAGES = REGISTRY.counter(
+    "broadcast_messages_total", "Broadcast deliveries by outcome.", ("outcome",)
+)
+BROADCAST_RETRY_AFTER = REGISTRY.counter(
+    "broadcast_retry_after_total", "429 responses (retry_after) received while broadcasting."
+)
+
+
+def create_bot(token: str, api_url: str = "") -> Bot:
+    """Bot for the official API, or for the server at ``api_url`` (e.g. a fake one)."""
+    if not api_url:
+        return Bot(token=token)
+    return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+
+
+class RateLimiter:
+    """Token bucket for all sends plus a minimum interval between sends to one chat.
+
+    ``pause`` stops every sender for the given time, for Telegram's
+    ``retry_after``.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, chat_interval: float = 1.0) -> None:
+        self.rate = max(rate, 0.001)
+        self.capacity = max(burst, 1)
+        self.chat_interval = chat_interval
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next: Dict[int, float] = {}
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: int) -> None:
+        while True:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self._chat_next.get(chat_id, 0.0) - now, 0.0)
+            if wait == 0.0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._remember_chat(chat_id, now)
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def _remember_chat(self, chat_id: int, now: float) -> None:
+        if self.chat_interval <= 0:
+            return
+        if len(self._chat_next) > 10000:
+            self._chat_next = {chat: at for chat, at in self._chat_next.items() if at > now}
+        self._chat_next[chat_id] = now + self.chat_interval
+
+
+class BroadcastRunner:
+    """Sends one broadcast from its checkpoint to the end.
+
+    Recipients are read in chunks of ``chunk_size`` users. A chunk is sent
+    with up to ``concurrency`` requests in flight and the limiter's pace, then
+    checkpointed, so a crash re-sends at most one chunk. Progress events go to
+    the event bus at most once a second. A recipient is given up on after
+    ``max_attempts`` network or server errors; 429s are not errors and are
+    retried until their ``retry_after`` waits add up to ``max_retry_wait``.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        bot: Bot,
+        bus: Any,
+        limiter: RateLimiter,
+        broadcast: Dict[str, Any],
+        owner: str,
+        chunk_size: int = 100,
+        concurrency: int = 20,
+        max_attempts: int = 5,
+        max_retry_wait: float = 600.0,
+        lease_seconds: float = 30.0,
+    ) -> None:
+        self.db = db
+        self.bot = bot
+        self.bus = bus
+        self.limiter = limiter
+        self.broadcast = broadcast
+        self.owner = owner
+        self.chunk_size = max(chunk_size, 1)
+        self.max_attempts = max_attempts
+        self.max_retry_wait = max_retry_wait
+        self.lease_seconds = lease_seconds
+        self._slots = asyncio.Semaphore(max(concurrency, 1))
+        self._last_event = 0.0
+        self._sent_at_last_event = broadcast["sent"]
+
+    @property
+    def id(self) -> int:
+        return self.broadcast["id"]
+
+    async def run(self) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self._run()
+        finally:
+            heartbeat.cancel()
+            try:
+                await heartbeat
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        logger.info(
+            "Broadcast %s: sending from user id %s", self.id, self.broadcast["last_user_id"]
+        )
+        while True:
+            chunk = await self.db.broadcast_recipients(
+                self.broadcast["last_user_id"], self.broadcast["max_user_id"], self.chunk_size
+            )
+            if not chunk:
+                finished = await self.db.finish_broadcast(self.id, self.owner)
+                if finished:
+                    self.broadcast = finished
+                    await self._publish("broadcast_finished", force=True)
+                    logger.info("Broadcast %s finished", self.id)
+                return
+            # A delivery that raises still counts as failed, so the checkpoint
+            # always moves past the chunk instead of re-sending it forever.
+            outcomes = await asyncio.gather(
+                *(self._deliver(tg_user_id) for _, tg_user_id in chunk), return_exceptions=True
+            )
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    logger.error("Broadcast %s: delivery crashed", self.id, exc_info=outcome)
+                    BROADCAST_MESSAGES.inc(outcome="failed")
+            checkpoint = await self.db.checkpoint_broadcast(
+                self.id,
+                self.owner,
+                last_user_id=chunk[-1][0],
+                sent=outcomes.count("sent"),
+                failed=len(outcomes) - outcomes.count("sent") - outcomes.count("blocked"),
+                blocked=outcomes.count("blocked"),
+            )
+            if checkpoint is None:
+                logger.warning("Broadcast %s was taken over by another worker", self.id)
+                return
+            self.broadcast = checkpoint
+            if checkpoint["status"] != "running":
+                await self._publish("broadcast_progress", force=True)
+                logger.info("Broadcast %s stopped: %s", self.id, checkpoint["status"])
+                return
+            await self._publish("broadcast_progress")
+
+    async def _deliver(self, chat_id: int) -> str:
+        async with self._slots:
+            backoff = 1.0
+            errors = 0
+            waited = 0.0
+            while errors < self.max_attempts:
+                await self.limiter.acquire(chat_id)
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=self.broadcast["text"])
+                    outcome = "sent"
+                except TelegramRetryAfter as exc:
+                    BROADCAST_RETRY_AFTER.inc()
+                    waited += exc.retry_after
+                    if waited > self.max_retry_wait:
+                        logger.warning(
+                            "Broadcast %s: giving up on %s after %ss of flood control",
+                            self.id,
+                            chat_id,
+                            waited,
+                        )
+                        break
+                    self.limiter.pause(exc.retry_after)
+                    continue
+                except TelegramForbiddenError:
+                    outcome = "blocked"
+                except TelegramBadRequest as exc:
+                    logger.info("Broadcast %s: cannot send to %s: %s", self.id, chat_id, exc)
+                    outcome = "failed"
+                except (TelegramNetworkError, TelegramServerError) as exc:
+                    logger.warning("Broadcast %s: error sending to %s: %s", self.id, chat_id, exc)
+                    errors += 1
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+                    continue
+                except TelegramAPIError as exc:
+                    # NotFound, Unauthorized, Conflict, EntityTooLarge and the like.
+                    logger.warning("Broadcast %s: cannot send to %s: %s", self.id, chat_id, exc)
+                    outcome = "failed"
+                BROADCAST_MESSAGES.inc(outcome=outcome)
+                return outcome
+            BROADCAST_MESSAGES.inc(outcome="failed")
+            return "failed"
+
+    async def _heartbeat(self) -> None:
+        # Keeps the lease while the limiter waits out a long retry_after.
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.db.heartbeat_broadcast(self.id, self.owner)
+            except Exception:
+                logger.exception("Broadcast %s: heartbeat failed", self.id)
+
+    async def _publish(self, event_type: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_event < 1.0:
+            return
+        elapsed = now - self._last_event if self._last_event else None
+        sent = self.broadcast["sent"]
+        rate = round((sent - self._sent_at_last_event) / elapsed, 1) if elapsed else None
+        self._last_event = now
+        self._sent_at_last_event = sent
+        event = {
+            "type": event_type,
+            "broadcast_id": self.id,
+            "status": self.broadcast["status"],
+            "total": self.broadcast["total"],
+            "sent": sent,
+            "failed": self.broadcast["failed"],
+            "blocked": self.broadcast["blocked"],
+            "messages_per_second": rate,
+        }
+        try:
+            await self.bus.publish([event])
+        except Exception:
+            logger.exception("Broadcast %s: failed to publish progress", self.id)
+
+
+class BroadcastManager:
+    """Runs broadcasts in this backend worker.
+
+    Every ``poll_interval`` seconds (or right after :meth:`wake`) the worker
+    claims the oldest pending broadcast, or a running one whose owner has not
+    sent a heartbeat for ``lease_seconds`` (crashed worker or restart), and
+    runs it from its checkpoint. All workers share one database, so each
+    broadcast runs in one worker at a time; the send rate limit applies per
+    worker.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        bus: Any,
+        bot: Bot,
+        rate: float = 25.0,
+        chat_interval: float = 1.0,
+        chunk_size: int = 100,
+        concurrency: int = 20,
+        lease_seconds: float = 30.0,
+        poll_interval: float = 5.0,
+    ) -> None:
+        self.db = db
+        self.bus = bus
+        self.bot = bot
+        self.limiter = RateLimiter(rate, burst=max(int(rate), 1), chat_interval=chat_interval)
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.current: Optional[BroadcastRunner] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.bot.session.close()
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def run_pending(self) -> List[int]:
+        """Run claimable broadcasts one after another; returns their ids."""
+        done = []
+        while True:
+            stale_before = datetime.now(tz=timezone.utc) - timedelta(seconds=self.lease_seconds)
+            broadcast = await self.db.claim_broadcast(self.owner, stale_before.strftime(ISO_FORMAT))
+            if broadcast is None:
+                return done
+            self.current = BroadcastRunner(
+                self.db,
+                self.bot,
+                self.bus,
+                self.limiter,
+                broadcast,
+                self.owner,
+                chunk_size=self.chunk_size,
+                concurrency=self.concurrency,
+                lease_seconds=self.lease_seconds,
+            )
+            try:
+                await self.current.run()
+            finally:
+                self.current = None
+            done.append(broadcast["id"])
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_pending()
+            except Exception:
+                logger.exception("Broadcast run failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+from .events import EventBroker
+
+logger = logging.getLogger(__name__)
+
+EVENT_BUS_KINDS = ("local", "sqlite")
+
+
+class LocalEventBus:
+    """Events reach only subscribers of this process (single worker)."""
+
+    def __init__(self, broker: EventBroker) -> None:
+        self.broker = broker
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, events: List[Dict[str, Any]]) -> None:
+        for event in events:
+            await self.broker.publish(event)
+
+
+class SqliteEventBus:
+    """Fans events out to every worker process through an SQLite outbox.
+
+    A worker that receives an event appends it to the outbox table; every
+    worker, including that one, tails the table and publishes new rows to its
+    own broker. Row ids are the events' sequence numbers, and the stream id
+    is stored next to the outbox, so every worker numbers events the same
+    way and a client can resume on any of them. Rows older than
+    ``retention_seconds`` are pruned. The outbox lives in its own file so it
+    does not contend with the bot's database.
+    """
+
+    def __init__(
+        self,
+        broker: EventBroker,
+        path: str,
+        poll_interval: float = 0.05,
+        retention_seconds: float = 300.0,
+        batch_size: int = 1000,
+    ) -> None:
+        self.broker = broker
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.batch_size = batch_size
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_id = 0
+
+    async def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._conn = await aiosqlite.connect(self.path)
+        await self._conn.execute("PRAGMA journal_mode = WAL")
+        await self._conn.execute("PRAGMA synchronous = NORMAL")
+        await self._conn.execute("PRAGMA busy_timeout = 5000")
+        await self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS event_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        await self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS event_outbox_stream (stream TEXT NOT NULL)"
+        )
+        await self._conn.execute(
+            """
+            INSERT INTO event_outbox_stream (stream)
+            SELECT ? WHERE NOT EXISTS (SELECT 1 FROM event_outbox_stream)
+            """,
+            (secrets.token_hex(8),),
+        )
+        await self._conn.commit()
+        cursor = await self._conn.execute("SELECT stream FROM event_outbox_stream LIMIT 1")
+        stream = (await cursor.fetchone())[0]
+        cursor = await self._conn.execute("SELECT IFNULL(MAX(id), 0) FROM event_outbox")
+        self._last_id = (await cursor.fetchone())[0]
+        self.broker.reset_sequence(stream, self._last_id)
+        self._task = asyncio.create_task(self._tail())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn:
+            await self._conn.close()
+            self._conn = None
+
+    async def publish(self, events: List[Dict[str, Any]]) -> None:
+        assert self._conn is not None
+        now = time.time()
+        await self._conn.executemany(
+            "INSERT INTO event_outbox (payload, created_at) VALUES (?, ?)",
+            [(json.dumps(event, ensure_ascii=False), now) for event in events],
+        )
+        await self._conn.commit()
+
+    async def _tail(self) -> None:
+        assert self._conn is not None
+        next_prune = time.monotonic() + self.retention_seconds
+        while True:
+            try:
+                cursor = await self._conn.execute(
+                    "SELECT id, payload FROM event_outbox WHERE id > ? ORDER BY id LIMIT ?",
+                    (self._last_id, self.batch_size),
+                )
+                rows = await cursor.fetchall()
+                for row_id, payload in rows:
+                    self._last_id = row_id
+                    await self.broker.publish(json.loads(payload), seq=row_id)
+                if time.monotonic() >= next_prune:
+                    await self._conn.execute(
+                        "DELETE FROM event_outbox WHERE created_at < ?",
+                        (time.time() - self.retention_seconds,),
+                    )
+                    await self._conn.commit()
+                    next_prune = time.monotonic() + self.retention_seconds
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to read event outbox")
+                rows = []
+            if len(rows) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+
+def create_event_bus(kind: str, broker: EventBroker, path: str, poll_interval_ms: int = 50):
+    if kind == "local":
+        return LocalEventBus(broker)
+    if kind == "sqlite":
+        return SqliteEventBus(broker, path, poll_interval=poll_interval_ms / 1000)
+    raise ValueError(f"Unknown event bus {kind!r}, expected one of {EVENT_BUS_KINDS}.")
@@ -0,0 +1,59 @@
+import secrets
+import time
+from typing import Any, Dict
+
+from app.db import Database
+
+# Tables whose contents change when the bot reports an event.
+EVENT_TABLES = {
+    "message_received": ("messages", "users"),
+    "greeting_sent": ("greetings", "users"),
+    "user_upserted": ("users",),
+    "broadcast_progress": ("broadcasts",),
+    "broadcast_finished": ("broadcasts",),
+}
+
+
+class ChangeTracker:
+    """Cheap change versions for ETags of the admin API reads.
+
+    A version combines a per-table counter, bumped by broker events and by
+    :meth:`bump` for the backend's own writes, with an epoch that moves
+    whenever SQLite's ``data_version`` changes. ``data_version`` is polled at
+    most every ``check_interval`` seconds, so between polls a request costs
+    no database access; writes that come without an event (retention,
+    maintenance commands, a backend that missed events) show up within
+    ``check_interval``.
+    """
+
+    def __init__(self, db: Database, check_interval: float = 1.0) -> None:
+        self.db = db
+        self.check_interval = check_interval
+        self._instance = secrets.token_hex(4)
+        self._counters: Dict[str, int] = {}
+        self._epoch = 0
+        self._data_version: Any = None
+        self._next_check = 0.0
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        """Broker listener."""
+        self.bump(*EVENT_TABLES.get(event.get("type"), ()))
+
+    def bump(self, *tables: str) -> None:
+        for table in tables:
+            self._counters[table] = self._counters.get(table, 0) + 1
+
+    async def _refresh(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        data_version = await self.db.data_version()
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._epoch += 1
+
+    async def etag(self, *tables: str) -> str:
+        await self._refresh()
+        counters = ".".join(str(self._counters.get(table, 0)) for table in tables)
+        return f'W/"{self._instance}-{self._epoch}-{counters}"'
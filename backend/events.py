@@ -1,27 +1,277 @@
 import asyncio
-from typing import Any, Dict, List
+import itertools
+import json
+import logging
+import secrets
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from app.db import utc_now
+
+logger = logging.getLogger(__name__)
+
+Listener = Callable[[Dict[str, Any]], None]
+
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+# WebSocket close code sent to a subscriber that fell too far behind.
+SLOW_CONSUMER_CLOSE_CODE = 4408
+
+# Upper bound for the tg_user_id set of one subscription.
+MAX_FILTER_USERS = 1000
+
+
+def encode_event(event: Dict[str, Any]) -> str:
+    return json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+
+
+class Subscriber:
+    """Bounded queue of encoded events for one WebSocket client.
+
+    ``event_types`` and ``tg_user_ids`` filter what the broker enqueues; None
+    lets everything through. The user filter only applies to events that
+    carry a ``user_id``.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, maxsize: int, policy: str) -> None:
+        self.id = next(self._ids)
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.connected_at = utc_now()
+        self.delivered = 0
+        self.dropped = 0
+        self.frames = 0
+        self.close_code: Optional[int] = None
+        self.event_types: Optional[FrozenSet[str]] = None
+        self.tg_user_ids: Optional[FrozenSet[int]] = None
+        # Events up to this sequence number were replayed from the ring buffer.
+        self.after_seq = 0
+        self._closing = False
+
+    @property
+    def lag(self) -> int:
+        return self.queue.qsize()
+
+    def set_filter(
+        self, event_types: Optional[Iterable[str]] = None, tg_user_ids: Optional[Iterable[int]] = None
+    ) -> None:
+        self.event_types = frozenset(event_types) if event_types is not None else None
+        self.tg_user_ids = frozenset(tg_user_ids) if tg_user_ids is not None else None
+
+    def wants(self, event: Dict[str, Any]) -> bool:
+        if self.event_types is not None and event.get("type") not in self.event_types:
+            return False
+        if self.tg_user_ids is not None and "user_id" in event:
+            return event["user_id"] in self.tg_user_ids
+        return True
+
+    def offer(self, payload: str) -> None:
+        if self.close_code is not None:
+            return
+        if not self.queue.full():
+            self.queue.put_nowait(payload)
+            return
+        if self.policy == "disconnect":
+            self.dropped += self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.close_code = SLOW_CONSUMER_CLOSE_CODE
+            self.queue.put_nowait(None)
+            return
+        self.queue.get_nowait()
+        self.queue.put_nowait(payload)
+        self.dropped += 1
+
+    async def get(self) -> Optional[str]:
+        """Next encoded event, or None once the subscriber has been cut off."""
+        payload = await self.queue.get()
+        if payload is not None:
+            self.delivered += 1
+            self.frames += 1
+        return payload
+
+    async def get_batch(self, max_events: int, max_wait: float) -> Optional[List[str]]:
+        """Up to ``max_events`` encoded events, waiting at most ``max_wait``
+        seconds after the first one; None once the subscriber has been cut off.
+        """
+        if self._closing:
+            return None
+        payload = await self.queue.get()
+        if payload is None:
+            return None
+        batch = [payload]
+        deadline = time.monotonic() + max_wait
+        while len(batch) < max_events:
+            if self.queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    payload = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                payload = self.queue.get_nowait()
+            if payload is None:
+                self._closing = True
+                break
+            batch.append(payload)
+        self.delivered += len(batch)
+        self.frames += 1
+        return batch
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "connected_at": self.connected_at,
+            "lag": self.lag,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "frames": self.frames,
+            "event_types": sorted(self.event_types) if self.event_types is not None else None,
+            "tg_user_ids": len(self.tg_user_ids) if self.tg_user_ids is not None else None,
+        }
 
 
 class EventBroker:
-    def __init__(self) -> None:
-        self._subscribers: List[asyncio.Queue] = []
+    """Fans published events out to listeners and WebSocket subscribers.
+
+    Every event gets a ``seq`` number, increasing within ``stream``, and the
+    last events are kept in a ring buffer bounded by ``replay_events`` and
+    ``replay_bytes`` so a reconnecting client can catch up with
+    :meth:`replay`. Buses that order events themselves (the SQLite outbox)
+    pass their own sequence numbers and stream id so every worker agrees.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 1000,
+        overflow_policy: str = "drop_oldest",
+        replay_events: int = 10000,
+        replay_bytes: int = 8 * 1024 * 1024,
+    ) -> None:
+        self._subscribers: List[Subscriber] = []
+        self._listeners: List[Listener] = []
+        self.configure(queue_size, overflow_policy, replay_events, replay_bytes)
+        self.published = 0
+        self.disconnected = 0
+        self.stream = secrets.token_hex(8)
+        self.last_seq = 0
+        # Everything after this sequence number is still in the ring buffer.
+        self._floor = 0
+        self._ring: Deque[Tuple[int, Dict[str, Any], str]] = deque()
+        self._ring_bytes = 0
+
+    @property
+    def subscribers(self) -> List[Subscriber]:
+        return list(self._subscribers)
+
+    def configure(
+        self,
+        queue_size: int,
+        overflow_policy: str,
+        replay_events: int = 10000,
+        replay_bytes: int = 8 * 1024 * 1024,
+    ) -> None:
+        """Set limits for subscribers created from now on and for the ring buffer."""
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy {overflow_policy!r}, expected one of {OVERFLOW_POLICIES}."
+            )
+        self.queue_size = max(queue_size, 1)
+        self.overflow_policy = overflow_policy
+        self.replay_events = max(replay_events, 0)
+        self.replay_bytes = max(replay_bytes, 0)
 
-    def subscribe(self) -> asyncio.Queue:
-        q: asyncio.Queue = asyncio.Queue()
-        self._subscribers.append(q)
-        return q
+    def reset_sequence(self, stream: str, last_seq: int) -> None:
+        """Continue a stream whose sequence numbers come from the event bus."""
+        self.stream = stream
+        self.last_seq = self._floor = last_seq
+        self._ring.clear()
+        self._ring_bytes = 0
 
-    def unsubscribe(self, queue: asyncio.Queue) -> None:
-        if queue in self._subscribers:
-            self._subscribers.remove(queue)
+    def replay(self, since: int, stream: Optional[str] = None) -> Optional[List[Tuple[Dict[str, Any], str]]]:
+        """Buffered events after ``since`` as (event, encoded) pairs, or None if
+        some of them are gone (or ``stream`` is not this one) and the client
+        has to resync.
+        """
+        if stream is not None and stream != self.stream:
+            return None
+        if stream is None and since > self.last_seq:
+            return None
+        if since < self._floor:
+            return None
+        return [(event, payload) for seq, event, payload in self._ring if seq > since]
 
-    async def publish(self, event: Dict[str, Any]) -> None:
-        for q in list(self._subscribers):
+    def _remember(self, seq: int, event: Dict[str, Any], payload: str) -> None:
+        self._ring.append((seq, event, payload))
+        self._ring_bytes += len(payload)
+        while self._ring and (
+            len(self._ring) > self.replay_events or self._ring_bytes > self.replay_bytes
+        ):
+            evicted, _, evicted_payload = self._ring.popleft()
+            self._ring_bytes -= len(evicted_payload)
+            self._floor = evicted
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self.queue_size, self.overflow_policy)
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        if subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+
+    def add_listener(self, listener: Listener) -> None:
+        """Call ``listener`` synchronously for every published event."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Listener) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    async def publish(self, event: Dict[str, Any], seq: Optional[int] = None) -> None:
+        self.published += 1
+        if seq is None:
+            seq = self.last_seq + 1
+        self.last_seq = max(self.last_seq, seq)
+        event = {**event, "seq": seq}
+        for listener in list(self._listeners):
             try:
-                q.put_nowait(event)
+                listener(event)
             except Exception:
-                pass
+                logger.exception("Event listener failed")
+        # Encoded once; the ring buffer and every subscriber share the string.
+        payload = encode_event(event)
+        self._remember(seq, event, payload)
+        for subscriber in list(self._subscribers):
+            if seq <= subscriber.after_seq or not subscriber.wants(event):
+                continue
+            was_open = subscriber.close_code is None
+            subscriber.offer(payload)
+            if was_open and subscriber.close_code is not None:
+                self.disconnected += 1
+                logger.warning(
+                    "Disconnecting slow WebSocket subscriber %s (%s events behind)",
+                    subscriber.id,
+                    self.queue_size,
+                )
 
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_size": self.queue_size,
+            "overflow_policy": self.overflow_policy,
+            "published": self.published,
+            "disconnected": self.disconnected,
+            "stream": self.stream,
+            "last_seq": self.last_seq,
+            "replay_events": len(self._ring),
+            "replay_bytes": self._ring_bytes,
+            "subscribers": [s.stats() for s in self._subscribers],
+        }
 
-broker = EventBroker()
 
+broker = EventBroker()
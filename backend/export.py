@@ -0,0 +1,49 @@
+import csv
+import io
+import json
+import zlib
+from typing import Any, AsyncIterator, Dict, Optional
+
+from app.db import ISO_FORMAT, parse_datetime
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Encoded rows are sent in pieces of about this many bytes.
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[str]:
+    """Normalize an ISO date or datetime (naive means UTC) to ``ISO_FORMAT``."""
+    if value is None:
+        return None
+    return parse_datetime(value).strftime(ISO_FORMAT)
+
+
+async def encode_rows(
+    rows: AsyncIterator[Dict[str, Any]], fmt: str, compress: bool = False
+) -> AsyncIterator[bytes]:
+    """Encode rows as NDJSON or CSV (header from the first row), optionally gzipped."""
+    gzip = zlib.compressobj(wbits=31) if compress else None
+    buffer = io.StringIO()
+    writer: Optional[Any] = None
+    async for row in rows:
+        if fmt == "csv":
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False))
+            buffer.write("\n")
+        if buffer.tell() >= EXPORT_FLUSH_BYTES:
+            data = buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            data = gzip.compress(data) if gzip else data
+            if data:
+                yield data
+    data = buffer.getvalue().encode()
+    if gzip:
+        data = gzip.compress(data) + gzip.flush()
+    if data:
+        yield data
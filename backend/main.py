@@ -1,11 +1,20 @@
 import os
-from fastapi import FastAPI
+import time
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
-from app.config import load_settings
+from app.config import settings_provider
 from app.db import Database
+from app.metrics import CONTENT_TYPE, REGISTRY
+from app.retention import MessageArchive, RetentionRunner
+from .broadcast import BroadcastManager, create_bot
+from .bus import create_event_bus
+from .changes import ChangeTracker
+from .events import broker
 from .routes import router
+from .stats import StatsEngine
 
 APP_PORT = int(os.getenv("BACKEND_PORT", "8011"))
 
@@ -21,14 +30,128 @@ app.add_middleware(
 )
 
 
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "backend_http_request_seconds", "HTTP request latency by route.", ("method", "route")
+)
+HTTP_RESPONSES = REGISTRY.counter(
+    "backend_http_responses_total", "HTTP responses by route and status.", ("method", "route", "status")
+)
+
+
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, route=route)
+    HTTP_RESPONSES.inc(method=request.method, route=route, status=response.status_code)
+    return response
+
+
+def register_metrics(db: Database, stats: StatsEngine) -> None:
+    REGISTRY.collector("db_commits_total", "SQLite commits.", lambda: db.commits, kind="counter")
+    REGISTRY.collector("ws_subscribers", "Connected WebSocket clients.", lambda: len(broker.subscribers))
+    REGISTRY.collector(
+        "ws_queue_depth",
+        "Events queued for WebSocket clients, total and for the slowest client.",
+        lambda: {
+            ("total",): sum(s.lag for s in broker.subscribers),
+            ("max",): max((s.lag for s in broker.subscribers), default=0),
+        },
+        labelnames=("aggregate",),
+    )
+    REGISTRY.collector(
+        "ws_events_published_total", "Events published to the broker.", lambda: broker.published, kind="counter"
+    )
+    REGISTRY.collector(
+        "ws_slow_disconnects_total",
+        "WebSocket clients cut off for falling behind.",
+        lambda: broker.disconnected,
+        kind="counter",
+    )
+    REGISTRY.collector(
+        "stats_events_since_recompute",
+        "Events applied to the /api/stats snapshot since the last full recompute.",
+        lambda: stats.events_since_recompute,
+    )
+
+
 @app.on_event("startup")
 async def startup_event() -> None:
-    settings = load_settings()
-    app.state.db = await Database.create(settings.db_path)
+    settings = settings_provider.get()
+    settings_provider.install_sighup_handler()
+    broker.configure(
+        settings.ws_queue_size,
+        settings.ws_overflow_policy,
+        replay_events=settings.ws_replay_events,
+        replay_bytes=settings.ws_replay_bytes,
+    )
+    app.state.bus = create_event_bus(
+        settings.event_bus,
+        broker,
+        settings.event_bus_path,
+        poll_interval_ms=settings.event_bus_poll_ms,
+    )
+    await app.state.bus.start()
+    app.state.db = await Database.create(
+        settings.db_path,
+        mode=settings.db_mode,
+        readers=settings.db_readers,
+        migrate_online=True,
+    )
+    app.state.stats = StatsEngine(
+        top_n=settings.stats_top_n, refresh_interval=settings.stats_refresh_seconds
+    )
+    broker.add_listener(app.state.stats.apply)
+    app.state.changes = ChangeTracker(
+        app.state.db, check_interval=settings.etag_check_interval_ms / 1000
+    )
+    broker.add_listener(app.state.changes.apply)
+    app.state.stats.start(app.state.db)
+    register_metrics(app.state.db, app.state.stats)
+    app.state.broadcasts = BroadcastManager(
+        app.state.db,
+        app.state.bus,
+        create_bot(settings.bot_token, settings.telegram_api_url),
+        rate=settings.broadcast_rate,
+        chat_interval=settings.broadcast_chat_interval_ms / 1000,
+        chunk_size=settings.broadcast_chunk_size,
+        concurrency=settings.broadcast_concurrency,
+        lease_seconds=settings.broadcast_lease_seconds,
+    )
+    app.state.broadcasts.start()
+    app.state.archive = MessageArchive(settings.archive_dir)
+    if settings.retention_days > 0:
+        app.state.retention = RetentionRunner(
+            app.state.db,
+            app.state.archive,
+            retention_days=settings.retention_days,
+            batch_size=settings.retention_batch_size,
+            interval=settings.retention_interval_seconds,
+            vacuum_pages=settings.retention_vacuum_pages,
+            rollup_minute_days=settings.rollup_minute_days,
+        )
+        app.state.retention.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event() -> None:
+    broadcasts: BroadcastManager | None = getattr(app.state, "broadcasts", None)
+    if broadcasts:
+        await broadcasts.stop()
+    retention: RetentionRunner | None = getattr(app.state, "retention", None)
+    if retention:
+        await retention.stop()
+    changes: ChangeTracker | None = getattr(app.state, "changes", None)
+    if changes:
+        broker.remove_listener(changes.apply)
+    stats: StatsEngine | None = getattr(app.state, "stats", None)
+    if stats:
+        broker.remove_listener(stats.apply)
+        await stats.stop()
+    bus = getattr(app.state, "bus", None)
+    if bus:
+        await bus.stop()
     db: Database | None = getattr(app.state, "db", None)
     if db:
         await db.close()
@@ -40,6 +163,12 @@ async def health() -> JSONResponse:
     return JSONResponse({"status": "ok", "db": db_status})
 
 
+@app.get("/metrics")
+async def metrics() -> Response:
+    # Per process: with several workers each scrape sees one of them.
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
 def run() -> None:
     # Convenience entrypoint for `python -m backend.main`
     import uvicorn
@@ -49,6 +178,8 @@ def run() -> None:
         host="0.0.0.0",
         port=APP_PORT,
         reload=bool(int(os.getenv("BACKEND_RELOAD", "0"))),
+        workers=int(os.getenv("BACKEND_WORKERS", "1")),
+        ws_per_message_deflate=bool(int(os.getenv("WS_PER_MESSAGE_DEFLATE", "1"))),
     )
 
 
@@ -1,13 +1,18 @@
-from datetime import datetime, timezone
+import asyncio
+import json
+from datetime import date, datetime, timezone
 from typing import Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
 
-from app.db import Database
+from app.db import EXPORT_QUERIES, SEARCH_ORDERS, Database, next_cursor, parse_datetime
+from app.retention import MessageArchive
 
-from .auth import _encode_token, clear_session_cookie, require_auth, set_session_cookie
-from app.config import load_settings
-from .events import broker
+from .auth import _encode_token, clear_session_cookie, get_settings, require_auth, set_session_cookie
+from .events import MAX_FILTER_USERS, SLOW_CONSUMER_CLOSE_CODE, broker, encode_event
+from .export import EXPORT_FORMATS, encode_rows, parse_timestamp
+from .stats import timeseries
 
 router = APIRouter()
 
@@ -19,8 +24,30 @@ def get_db(request: Request) -> Database:
     return db
 
 
+def get_bus(request: Request):
+    return request.app.state.bus
+
+
+async def not_modified(request: Request, response: Response, *tables: str) -> Optional[Response]:
+    """Set the ETag for ``tables``; a 304 response if the client already has it."""
+    changes = getattr(request.app.state, "changes", None)
+    if changes is None:
+        return None
+    etag = await changes.etag(*tables)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def invalid_cursor() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_cursor")
+
+
 @router.post("/api/auth/login")
-async def login(payload: dict, response: Response, settings=Depends(load_settings)):
+async def login(payload: dict, response: Response, settings=Depends(get_settings)):
     login = (payload.get("login") or "").strip()
     password = (payload.get("password") or "").strip()
     if login != settings.admin_login or password != settings.admin_password:
@@ -43,23 +70,62 @@ async def me(login: str = Depends(require_auth)):
 
 @router.get("/api/users")
 async def list_users(
+    request: Request,
+    response: Response,
     db: Database = Depends(get_db),
     _: str = Depends(require_auth),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
+):
+    cached = await not_modified(request, response, "users")
+    if cached:
+        return cached
+    try:
+        users = await db.list_users(limit=limit, offset=offset, cursor=cursor)
+    except ValueError:
+        raise invalid_cursor()
+    return {
+        "items": users,
+        "limit": limit,
+        "offset": offset,
+        "next_cursor": next_cursor(users, "last_seen_at", limit),
+    }
+
+
+@router.get("/api/users/search")
+async def search_users(
+    request: Request,
+    response: Response,
+    db: Database = Depends(get_db),
+    _: str = Depends(require_auth),
+    q: str = Query(..., min_length=1, max_length=64),
+    limit: int = Query(20, ge=1, le=50),
 ):
-    users = await db.list_users(limit=limit, offset=offset)
-    return {"items": users, "limit": limit, "offset": offset}
+    cached = await not_modified(request, response, "users")
+    if cached:
+        return cached
+    users = await db.search_users(q, limit=limit)
+    if users is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="search_not_ready"
+        )
+    return {"items": users, "q": q, "limit": limit}
 
 
 @router.get("/api/users/{tg_user_id}")
 async def user_details(
     tg_user_id: int,
+    request: Request,
+    response: Response,
     db: Database = Depends(get_db),
     _: str = Depends(require_auth),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
 ):
+    cached = await not_modified(request, response, "users", "greetings", "messages")
+    if cached:
+        return cached
     user = await db.get_user(tg_user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="not_found")
@@ -70,52 +136,316 @@ async def user_details(
 
 @router.get("/api/greetings")
 async def greetings(
+    request: Request,
+    response: Response,
     db: Database = Depends(get_db),
     _: str = Depends(require_auth),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
     tg_user_id: Optional[int] = Query(None),
+    cursor: Optional[str] = Query(None),
 ):
-    items = await db.list_greetings(limit=limit, offset=offset, tg_user_id=tg_user_id)
-    return {"items": items, "limit": limit, "offset": offset}
+    cached = await not_modified(request, response, "greetings")
+    if cached:
+        return cached
+    try:
+        items = await db.list_greetings(
+            limit=limit, offset=offset, tg_user_id=tg_user_id, cursor=cursor
+        )
+    except ValueError:
+        raise invalid_cursor()
+    return {
+        "items": items,
+        "limit": limit,
+        "offset": offset,
+        "next_cursor": next_cursor(items, "sent_at", limit),
+    }
 
 
 @router.get("/api/messages")
 async def messages(
+    request: Request,
+    response: Response,
     db: Database = Depends(get_db),
     _: str = Depends(require_auth),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
     tg_user_id: Optional[int] = Query(None),
     message_type: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    q: Optional[str] = Query(None),
+    order: str = Query("rank"),
 ):
-    items = await db.list_messages(
-        limit=limit, offset=offset, tg_user_id=tg_user_id, message_type=message_type
+    cached = await not_modified(request, response, "messages")
+    if cached:
+        return cached
+    if q is not None:
+        if not q.strip():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_query")
+        if order not in SEARCH_ORDERS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_order")
+        try:
+            items = await db.search_messages(
+                q,
+                limit=limit,
+                tg_user_id=tg_user_id,
+                message_type=message_type,
+                cursor=cursor,
+                order=order,
+            )
+        except ValueError:
+            raise invalid_cursor()
+        if items is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="search_not_ready"
+            )
+        return {
+            "items": items,
+            "limit": limit,
+            "offset": 0,
+            "next_cursor": next_cursor(items, "rank" if order == "rank" else "id", limit),
+        }
+    try:
+        items = await db.list_messages(
+            limit=limit,
+            offset=offset,
+            tg_user_id=tg_user_id,
+            message_type=message_type,
+            cursor=cursor,
+        )
+    except ValueError:
+        raise invalid_cursor()
+    return {
+        "items": items,
+        "limit": limit,
+        "offset": offset,
+        "next_cursor": next_cursor(items, "received_at", limit),
+    }
+
+
+@router.get("/api/export/{kind}")
+async def export(
+    kind: str,
+    db: Database = Depends(get_db),
+    _: str = Depends(require_auth),
+    format: str = Query("ndjson"),
+    gzip: bool = Query(False),
+    since: Optional[str] = Query(None),
+    until: Optional[str] = Query(None),
+    tg_user_id: Optional[int] = Query(None),
+):
+    if kind not in EXPORT_QUERIES:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="not_found")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_format")
+    try:
+        since, until = parse_timestamp(since), parse_timestamp(until)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_date")
+    rows = db.export_rows(kind, since=since, until=until, tg_user_id=tg_user_id)
+    filename = f"{kind}.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        encode_rows(rows, format, compress=gzip),
+        media_type="application/gzip" if gzip else EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
-    return {"items": items, "limit": limit, "offset": offset}
+
+
+def get_archive(request: Request) -> MessageArchive:
+    return request.app.state.archive
+
+
+def check_day(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_date")
+
+
+@router.get("/api/archive/days")
+async def archive_days(archive: MessageArchive = Depends(get_archive), _: str = Depends(require_auth)):
+    return {"items": await asyncio.to_thread(archive.days)}
+
+
+@router.get("/api/archive/messages")
+async def archived_messages(
+    archive: MessageArchive = Depends(get_archive),
+    _: str = Depends(require_auth),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    tg_user_id: Optional[int] = Query(None),
+    message_type: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+):
+    try:
+        items = await asyncio.to_thread(
+            archive.query,
+            date_from=check_day(date_from),
+            date_to=check_day(date_to),
+            tg_user_id=tg_user_id,
+            message_type=message_type,
+            limit=limit,
+            cursor=cursor,
+        )
+    except ValueError:
+        raise invalid_cursor()
+    return {"items": items, "limit": limit, "next_cursor": next_cursor(items, "received_at", limit)}
+
+
+BROADCAST_ACTIONS = {
+    "pause": ("paused", ("pending", "running")),
+    "resume": ("pending", ("paused",)),
+    "cancel": ("cancelled", ("pending", "running", "paused")),
+}
+
+
+@router.get("/api/broadcasts")
+async def list_broadcasts(
+    request: Request, response: Response, db: Database = Depends(get_db), _: str = Depends(require_auth)
+):
+    cached = await not_modified(request, response, "broadcasts")
+    if cached:
+        return cached
+    return {"items": await db.list_broadcasts()}
+
+
+@router.post("/api/broadcasts")
+async def create_broadcast(
+    payload: dict, request: Request, db: Database = Depends(get_db), _: str = Depends(require_auth)
+):
+    text = (payload.get("text") or "").strip()
+    if not text:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="text_required")
+    broadcast = await db.create_broadcast(text)
+    request.app.state.changes.bump("broadcasts")
+    request.app.state.broadcasts.wake()
+    return broadcast
+
+
+@router.get("/api/broadcasts/{broadcast_id}")
+async def broadcast_details(
+    broadcast_id: int, db: Database = Depends(get_db), _: str = Depends(require_auth)
+):
+    broadcast = await db.get_broadcast(broadcast_id)
+    if not broadcast:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="not_found")
+    return broadcast
+
+
+@router.post("/api/broadcasts/{broadcast_id}/{action}")
+async def control_broadcast(
+    broadcast_id: int,
+    action: str,
+    request: Request,
+    db: Database = Depends(get_db),
+    _: str = Depends(require_auth),
+):
+    if action not in BROADCAST_ACTIONS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="not_found")
+    new_status, from_statuses = BROADCAST_ACTIONS[action]
+    broadcast = await db.set_broadcast_status(broadcast_id, new_status, from_statuses)
+    if broadcast is None:
+        if not await db.get_broadcast(broadcast_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="not_found")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="invalid_state")
+    request.app.state.changes.bump("broadcasts")
+    if new_status == "pending":
+        request.app.state.broadcasts.wake()
+    return broadcast
 
 
 @router.get("/api/stats")
-async def stats(db: Database = Depends(get_db), _: str = Depends(require_auth)):
-    data = await db.get_stats()
-    return data
+async def stats(
+    request: Request, response: Response, db: Database = Depends(get_db), _: str = Depends(require_auth)
+):
+    cached = await not_modified(request, response, "users", "greetings", "messages")
+    if cached:
+        return cached
+    engine = getattr(request.app.state, "stats", None)
+    if engine is None:
+        return await db.get_stats()
+    return await engine.get(db)
 
 
-@router.post("/api/internal/events")
-async def publish_event(
-    payload: dict, request: Request, settings=Depends(load_settings)
-):  
+@router.get("/api/stats/timeseries")
+async def stats_timeseries(
+    db: Database = Depends(get_db),
+    _: str = Depends(require_auth),
+    granularity: str = Query("hour"),
+    since: Optional[str] = Query(None),
+    until: Optional[str] = Query(None),
+    metrics: Optional[str] = Query(None, description="comma-separated, e.g. messages,greetings"),
+):
+    try:
+        since_at = parse_datetime(since) if since else None
+        until_at = parse_datetime(until) if until else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_date")
+    names = [name.strip() for name in metrics.split(",") if name.strip()] if metrics else None
+    try:
+        return await timeseries(db, granularity, since_at, until_at, names)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid_range")
+
+
+@router.get("/api/realtime/stats")
+async def realtime_stats(_: str = Depends(require_auth)):
+    return broker.stats()
+
+
+def check_internal_secret(request: Request, settings) -> None:
     secret = request.headers.get("X-Auth-Secret", "")
     if secret != settings.auth_secret:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="unauthorized")
-    await broker.publish(payload)
+
+
+@router.post("/api/internal/events")
+async def publish_event(
+    payload: dict, request: Request, settings=Depends(get_settings), bus=Depends(get_bus)
+):
+    check_internal_secret(request, settings)
+    await bus.publish([payload])
     return {"ok": True}
 
 
+@router.post("/api/internal/events/batch")
+async def publish_events_batch(
+    payload: dict, request: Request, settings=Depends(get_settings), bus=Depends(get_bus)
+):
+    check_internal_secret(request, settings)
+    events = payload.get("events")
+    if not isinstance(events, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="events_required")
+    await bus.publish([event for event in events if isinstance(event, dict)])
+    return {"ok": True, "count": len(events)}
+
+
+def parse_subscription(event_types, user_ids):
+    """Validated (event types, user ids) of a subscription; None means no filter."""
+    if event_types is not None:
+        if not isinstance(event_types, list):
+            raise ValueError("events must be a list")
+        event_types = [str(item) for item in event_types]
+    if user_ids is not None:
+        if not isinstance(user_ids, list):
+            raise ValueError("tg_user_ids must be a list")
+        user_ids = [int(item) for item in user_ids]
+        if len(user_ids) > MAX_FILTER_USERS:
+            raise ValueError("too many users")
+    return event_types, user_ids
+
+
+def split_param(value: Optional[str]):
+    return [item for item in value.split(",") if item] if value is not None else None
+
+
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     token = websocket.cookies.get("session_token")
-    settings = load_settings()
+    settings = await get_settings()
     login = None
     if token:
         from .auth import _decode_token  # local import to avoid cycle
@@ -125,14 +455,97 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close(code=4401)
         return
     await websocket.accept()
-    queue = broker.subscribe()
+    params = websocket.query_params
+    invalid_subscription = encode_event({"type": "error", "detail": "invalid_subscription"})
+    subscriber = broker.subscribe()
     try:
+        subscriber.set_filter(
+            *parse_subscription(split_param(params.get("events")), split_param(params.get("tg_user_ids")))
+        )
+    except (ValueError, TypeError):
+        subscriber.offer(invalid_subscription)
+    batching = {"enabled": params.get("batch") in ("1", "true")}
+    # Subscribing and reading the ring buffer happen without a pause in
+    # between, so the replay and the live queue neither overlap nor leave a gap.
+    replayed = []
+    resync = False
+    if params.get("since") is not None:
+        try:
+            since = int(params["since"])
+        except ValueError:
+            since = -1
+        missed = broker.replay(since, params.get("stream")) if since >= 0 else None
+        if missed is None:
+            resync = True
+        else:
+            subscriber.after_seq = max(since, broker.last_seq)
+            replayed = [payload for event, payload in missed if subscriber.wants(event)]
+    hello = {
+        "type": "hello",
+        "stream": broker.stream,
+        "seq": broker.last_seq,
+        "replayed": len(replayed),
+        "resync": resync,
+    }
+
+    async def receive() -> None:
+        # Subscription messages; the acknowledgement goes through the event
+        # queue so it is ordered with the events that follow it.
         while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if frame.get("text") is None:
+                # Binary frame: 1003 is "unsupported data".
+                await websocket.close(code=1003)
+                return
             try:
-                event = await queue.get()
-                await websocket.send_json(event)
-            except WebSocketDisconnect:
-                break
-    finally:
-        broker.unsubscribe(queue)
+                message = json.loads(frame["text"])
+                if not isinstance(message, dict) or message.get("type") != "subscribe":
+                    raise ValueError("not a subscription")
+                event_types, user_ids = parse_subscription(message.get("events"), message.get("tg_user_ids"))
+            except (ValueError, TypeError):
+                subscriber.offer(invalid_subscription)
+                continue
+            subscriber.set_filter(event_types, user_ids)
+            batching["enabled"] = bool(message.get("batch"))
+            subscriber.offer(
+                encode_event(
+                    {
+                        "type": "subscribed",
+                        "events": event_types,
+                        "tg_user_ids": user_ids,
+                        "batch": batching["enabled"],
+                    }
+                )
+            )
 
+    async def send() -> None:
+        await websocket.send_text(encode_event(hello))
+        step = settings.ws_batch_max if batching["enabled"] else 1
+        for start in range(0, len(replayed), max(step, 1)):
+            chunk = replayed[start : start + step]
+            await websocket.send_text("[" + ",".join(chunk) + "]" if batching["enabled"] else chunk[0])
+        while True:
+            if batching["enabled"]:
+                batch = await subscriber.get_batch(settings.ws_batch_max, settings.ws_batch_ms / 1000)
+                payload = "[" + ",".join(batch) + "]" if batch is not None else None
+            else:
+                payload = await subscriber.get()
+            if payload is None:
+                await websocket.close(code=subscriber.close_code or SLOW_CONSUMER_CLOSE_CODE)
+                return
+            await websocket.send_text(payload)
+
+    tasks = [asyncio.create_task(receive()), asyncio.create_task(send())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, WebSocketDisconnect, RuntimeError):
+                pass
+        broker.unsubscribe(subscriber)
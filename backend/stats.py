@@ -0,0 +1,213 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.db import ISO_FORMAT, ROLLUP_GRANULARITIES, ROLLUP_METRICS, Database, utc_now
+
+logger = logging.getLogger(__name__)
+
+# How many greeters beyond the visible top are tracked between recomputes, so
+# a user climbing into the top N is noticed without querying the database.
+CANDIDATES_FACTOR = 5
+
+BUCKET_STEPS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+# Default number of buckets when a time-series request has no ``since``.
+DEFAULT_TIMESERIES_POINTS = 60
+MAX_TIMESERIES_POINTS = 5000
+
+
+def bucket_name(moment: datetime, granularity: str) -> str:
+    return moment.strftime(ISO_FORMAT)[: ROLLUP_GRANULARITIES[granularity]]
+
+
+def bucket_floor(moment: datetime, granularity: str) -> datetime:
+    moment = moment.replace(second=0, microsecond=0)
+    if granularity in ("hour", "day"):
+        moment = moment.replace(minute=0)
+    if granularity == "day":
+        moment = moment.replace(hour=0)
+    return moment
+
+
+async def timeseries(
+    db: Database,
+    granularity: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    metrics: Optional[Sequence[str]] = None,
+) -> Dict[str, Any]:
+    """Zero-filled points of the rollups for buckets starting in [since, until).
+
+    Defaults to the last :data:`DEFAULT_TIMESERIES_POINTS` buckets and to every
+    base metric plus the per-type message counts present in the range. Raises
+    ValueError on an unknown granularity or more than
+    :data:`MAX_TIMESERIES_POINTS` buckets. ``ready`` is False while the
+    rollups of an existing database are still being backfilled, so older
+    buckets may be incomplete.
+    """
+    if granularity not in ROLLUP_GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}")
+    step = BUCKET_STEPS[granularity]
+    until = until or datetime.now(tz=timezone.utc) + step
+    since = since or until - step * DEFAULT_TIMESERIES_POINTS
+    buckets: List[str] = []
+    moment = bucket_floor(since, granularity)
+    while moment < until:
+        if len(buckets) >= MAX_TIMESERIES_POINTS:
+            raise ValueError("too many buckets")
+        buckets.append(bucket_name(moment, granularity))
+        moment += step
+    rows = []
+    if buckets:
+        rows = await db.get_rollups(
+            granularity, buckets[0], bucket_name(moment, granularity), metrics
+        )
+    names = list(metrics) if metrics else list(ROLLUP_METRICS)
+    for row in rows:
+        if row["metric"] not in names:
+            names.append(row["metric"])
+    points = {bucket: {"bucket": bucket, **{name: 0 for name in names}} for bucket in buckets}
+    for row in rows:
+        points[row["bucket"]][row["metric"]] = row["value"]
+    return {
+        "granularity": granularity,
+        "metrics": names,
+        "points": list(points.values()),
+        "ready": not await db.rollups_pending(),
+    }
+
+
+class StatsEngine:
+    """In-memory /api/stats snapshot.
+
+    A full recompute from the database runs on start and then every
+    ``refresh_interval`` seconds. In between, totals and the top greeters are
+    adjusted from broker events. Users outside the tracked candidates are
+    counted from zero until the next recompute, which also corrects any drift
+    (lost events, writes the bot made while the backend was down).
+    """
+
+    def __init__(self, top_n: int = 10, refresh_interval: float = 300.0) -> None:
+        self.top_n = top_n
+        self.refresh_interval = refresh_interval
+        self._totals: Dict[str, int] = {}
+        self._greeters: Dict[int, int] = {}
+        self._greetings: Dict[int, Dict[str, Any]] = {}
+        self._computed_at: Optional[str] = None
+        self._computed_monotonic = 0.0
+        self._updated_at: Optional[str] = None
+        self._events_since_recompute = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def events_since_recompute(self) -> int:
+        return self._events_since_recompute
+
+    @property
+    def ready(self) -> bool:
+        return self._computed_at is not None
+
+    async def recompute(self, db: Database) -> None:
+        async with self._lock:
+            data = await db.get_stats(top_limit=self.top_n * CANDIDATES_FACTOR)
+            self._totals = {
+                "total_users": data["total_users"],
+                "total_greetings": data["total_greetings"],
+                "total_messages": data["total_messages"],
+            }
+            self._greeters = {
+                row["tg_user_id"]: row["greetings_count"] for row in data["top_users"]
+            }
+            self._greetings = {row["greeting_id"]: dict(row) for row in data["top_greetings"]}
+            self._computed_at = utc_now()
+            self._updated_at = self._computed_at
+            self._computed_monotonic = time.monotonic()
+            self._events_since_recompute = 0
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        """Broker listener: fold one event into the snapshot."""
+        if not self.ready:
+            return
+        event_type = event.get("type")
+        if event_type == "greeting_sent":
+            self._totals["total_greetings"] += 1
+            user_id = event.get("user_id")
+            if user_id is not None:
+                self._greeters[user_id] = self._greeters.get(user_id, 0) + 1
+                self._trim_greeters()
+            greeting_id = event.get("greeting_id")
+            if greeting_id is not None:
+                entry = self._greetings.setdefault(
+                    greeting_id,
+                    {"greeting_id": greeting_id, "text": event.get("text"), "sent_count": 0},
+                )
+                entry["sent_count"] += 1
+        elif event_type == "message_received":
+            self._totals["total_messages"] += 1
+            if event.get("is_new_user"):
+                self._totals["total_users"] += 1
+        elif event_type == "user_upserted":
+            if event.get("is_new"):
+                self._totals["total_users"] += 1
+        else:
+            return
+        self._events_since_recompute += 1
+        self._updated_at = utc_now()
+
+    def _trim_greeters(self) -> None:
+        limit = self.top_n * CANDIDATES_FACTOR
+        if len(self._greeters) > limit * 2:
+            self._greeters = dict(
+                heapq.nlargest(limit, self._greeters.items(), key=lambda item: item[1])
+            )
+
+    def snapshot(self) -> Dict[str, Any]:
+        top = heapq.nlargest(self.top_n, self._greeters.items(), key=lambda item: item[1])
+        return {
+            **self._totals,
+            "top_users": [
+                {"tg_user_id": user_id, "greetings_count": count} for user_id, count in top
+            ],
+            "top_greetings": heapq.nlargest(
+                self.top_n, self._greetings.values(), key=lambda entry: entry["sent_count"]
+            ),
+            "computed_at": self._computed_at,
+            "updated_at": self._updated_at,
+            "stale_seconds": round(time.monotonic() - self._computed_monotonic, 3),
+            "events_since_recompute": self._events_since_recompute,
+        }
+
+    async def get(self, db: Database) -> Dict[str, Any]:
+        if not self.ready:
+            await self.recompute(db)
+        return self.snapshot()
+
+    def start(self, db: Database) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, db: Database) -> None:
+        while True:
+            try:
+                await self.recompute(db)
+            except Exception:
+                logger.exception("Stats recompute failed")
+            await asyncio.sleep(self.refresh_interval)
@@ -1,4 +1,4 @@
-import { useEffect, useMemo, useState } from "react";
+import { useEffect, useMemo, useRef, useState } from "react";
 import "./style.css";
 
 const API_BASE = "http://localhost:8011";
@@ -70,11 +70,19 @@ function LoginForm({ onLogin }) {
   );
 }
 
-function UsersTab({ data, refresh }) {
+function UsersTab({ data, refresh, query, setQuery }) {
   return (
     <section>
       <div className="toolbar">
         <h3>Users</h3>
+        <div className="filters">
+          <input
+            placeholder="@username, имя или tg_user_id"
+            maxLength={64}
+            value={query}
+            onChange={(e) => setQuery(e.target.value)}
+          />
+        </div>
         <button onClick={refresh}>Обновить</button>
       </div>
       <div className="table">
@@ -184,6 +192,9 @@ function MessagesTab({
 function Dashboard({ onLogout }) {
   const [activeTab, setActiveTab] = useState("users");
   const [users, setUsers] = useState({ items: [] });
+  const [userQuery, setUserQuery] = useState("");
+  // The WebSocket handler keeps the first loadUsers; it reads the query from here.
+  const userQueryRef = useRef("");
   const [greetings, setGreetings] = useState({ items: [] });
   const [messages, setMessages] = useState({ items: [] });
   const [filterGreetingUser, setFilterGreetingUser] = useState("");
@@ -192,8 +203,12 @@ function Dashboard({ onLogout }) {
   const [wsStatus, setWsStatus] = useState("disconnected");
 
   const loadUsers = async () => {
-    const data = await api("/api/users");
-    setUsers(data);
+    const query = userQueryRef.current.trim();
+    const data = await api(
+      query ? `/api/users/search?${new URLSearchParams({ q: query })}` : "/api/users"
+    );
+    // Drop answers for a query the user has already changed.
+    if (query === userQueryRef.current.trim()) setUsers(data);
   };
   const loadGreetings = async () => {
     const params = new URLSearchParams();
@@ -210,8 +225,10 @@ function Dashboard({ onLogout }) {
   };
 
   useEffect(() => {
-    loadUsers();
-  }, []);
+    userQueryRef.current = userQuery;
+    const timer = setTimeout(loadUsers, userQuery ? 150 : 0);
+    return () => clearTimeout(timer);
+  }, [userQuery]);
 
   useEffect(() => {
     if (activeTab === "greetings") loadGreetings();
@@ -224,9 +241,19 @@ function Dashboard({ onLogout }) {
   useEffect(() => {
     let ws;
     let retry = 0;
+    let stream = null;
+    let seq = null;
     const connect = () => {
       setWsStatus("connecting");
-      ws = new WebSocket(WS_BASE);
+      const params = new URLSearchParams({
+        events: "user_upserted,greeting_sent,message_received",
+        batch: "1",
+      });
+      if (stream !== null && seq !== null) {
+        params.set("stream", stream);
+        params.set("since", seq);
+      }
+      ws = new WebSocket(`${WS_BASE}?${params}`);
       ws.onopen = () => {
         setWsStatus("connected");
         retry = 0;
@@ -234,13 +261,26 @@ function Dashboard({ onLogout }) {
       ws.onmessage = (event) => {
         try {
           const data = JSON.parse(event.data);
-          if (data.type === "user_upserted") {
+          const items = Array.isArray(data) ? data : [data];
+          const types = new Set(items.map((item) => item.type));
+          for (const item of items) {
+            if (item.type === "hello") {
+              seq = item.stream === stream ? Math.max(seq ?? 0, item.seq) : item.seq;
+              stream = item.stream;
+              if (item.resync) {
+                types.add("user_upserted").add("greeting_sent").add("message_received");
+              }
+            } else if (typeof item.seq === "number") {
+              seq = Math.max(seq ?? 0, item.seq);
+            }
+          }
+          if (types.has("user_upserted")) {
             loadUsers();
           }
-          if (data.type === "greeting_sent") {
+          if (types.has("greeting_sent")) {
             loadGreetings();
           }
-          if (data.type === "message_received") {
+          if (types.has("message_received")) {
             loadMessages();
           }
         } catch (e) {
@@ -261,7 +301,14 @@ function Dashboard({ onLogout }) {
 
   const tabContent = useMemo(() => {
     if (activeTab === "users")
-      return <UsersTab data={users} refresh={loadUsers} />;
+      return (
+        <UsersTab
+          data={users}
+          refresh={loadUsers}
+          query={userQuery}
+          setQuery={setUserQuery}
+        />
+      );
     if (activeTab === "greetings")
       return (
         <GreetingsTab
@@ -286,6 +333,7 @@ function Dashboard({ onLogout }) {
     users,
     greetings,
     messages,
+    userQuery,
     filterGreetingUser,
     filterMessageUser,
     filterMessageType,
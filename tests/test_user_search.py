@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+
+from app.db import Database
+
+
+async def _search(db_path: str, query: str):
+    db = await Database.create(db_path)
+    try:
+        await db.upsert_user(42, "Anna", "Petrova", "anna")
+        return await db.search_users(query)
+    finally:
+        await db.close()
+
+
+@pytest.mark.parametrize("query", ["²", "٤٢", "99999999999999999999", str(2**63)])
+def test_non_int64_digits_are_searched_as_text(tmp_path, query):
+    assert asyncio.run(_search(str(tmp_path / "bot.db"), query)) == []
+
+
+def test_numeric_query_matches_tg_user_id(tmp_path):
+    rows = asyncio.run(_search(str(tmp_path / "bot.db"), "42"))
+    assert [row["tg_user_id"] for row in rows] == [42]
@@ -0,0 +1 @@
+"""Development helpers: fake Telegram clients and servers for offline runs."""
@@ -0,0 +1,290 @@
+"""Offline throughput benchmark of the bot's update pipeline.
+
+Builds the real Dispatcher (router + MessageLoggingMiddleware, message log
+pipeline, upsert cache, event shipper) on a temporary database, swaps the
+bot's HTTP session for one that records API calls, and feeds synthetic
+updates through ``dp.feed_update``. Events are shipped to a local sink that
+only counts them.
+
+Example::
+
+    python -m tools.bench_pipeline --count 20000 --concurrency 64 \\
+        --mix message=0.7,greet=0.2,callback=0.1 --output bench/$(date +%F).json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message, Update
+from aiohttp import web
+
+from app import handlers
+from app.db import Database
+from app.events import EventShipper
+from app.message_log import BACKPRESSURE_POLICIES, MessageLogPipeline
+from app.middleware import HandlerMetricsMiddleware, MessageLoggingMiddleware
+from app.texts import GREETINGS
+from app.user_cache import UserUpsertCache
+
+from .fake_telegram import callback_update, message_update
+
+UPDATE_KINDS = ("message", "greet", "start", "callback")
+
+
+class RecordingSession(BaseSession):
+    """Bot session that answers every API call locally and counts them by method."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: Counter = Counter()
+        self._message_ids = 0
+
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, SendMessage):
+            self._message_ids += 1
+            return Message(
+                message_id=self._message_ids,
+                date=datetime.now(tz=timezone.utc),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        """Count the download; there are no files offline, so the stream is empty."""
+        self.calls["stream_content"] += 1
+        return
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class EventSink:
+    """Local stand-in for the backend's batch events endpoint."""
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.port = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _batch(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.received += len(payload.get("events") or [])
+        return web.json_response({"ok": True})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/api/internal/events/batch", self._batch)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+def parse_mix(raw: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in raw.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in UPDATE_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown update kind {kind!r}, expected {UPDATE_KINDS}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def build_updates(bot: Bot, count: int, users: int, mix: Dict[str, float], seed: int) -> List[Update]:
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    updates = []
+    for i, kind in enumerate(kinds):
+        user_id = rng.randrange(1, users + 1)
+        if kind == "callback":
+            data = callback_update(user_id)
+        elif kind == "greet":
+            data = message_update(user_id, "/greet")
+        elif kind == "start":
+            data = message_update(user_id, "/start")
+        else:
+            data = message_update(user_id, f"synthetic message {i}")
+        updates.append(Update.model_validate(data, context={"bot": bot}))
+    return updates
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        return await _run(args, args.db or os.path.join(workdir, "bench.db"))
+
+
+async def _run(args: argparse.Namespace, db_path: str) -> Dict[str, Any]:
+    db = await Database.create(
+        db_path,
+        mode="wal",
+        write_behind=args.write_behind,
+        flush_interval_ms=args.flush_interval_ms,
+    )
+    await db.sync_greetings(GREETINGS)
+    sink = EventSink()
+    await sink.start()
+    shipper = EventShipper(f"http://127.0.0.1:{sink.port}", "bench", flush_interval=0.05)
+    await shipper.start()
+    user_cache = UserUpsertCache(max_size=args.users * 2, seen_window=60)
+    pipeline = MessageLogPipeline(
+        db,
+        shipper=shipper,
+        workers=args.log_workers,
+        batch_size=args.log_batch_size,
+        policy=args.log_backpressure,
+        user_cache=user_cache,
+    )
+    handlers.set_db(db)
+    handlers.set_event_shipper(shipper)
+    handlers.set_user_cache(user_cache)
+    pipeline.start()
+
+    session = RecordingSession()
+    bot = Bot(token="42:BENCHMARK", session=session)
+    dp = Dispatcher()
+    dp.include_router(handlers.router)
+    dp.message.middleware(MessageLoggingMiddleware(pipeline))
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    updates = build_updates(bot, args.count, args.users, parse_mix(args.mix), args.seed)
+
+    commits_before = db.commits
+    latencies: List[float] = []
+    errors = 0
+    pending = iter(enumerate(updates))
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def worker() -> None:
+        nonlocal errors
+        for index, update in pending:
+            if args.rate > 0:
+                delay = started + index / args.rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            begin = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - begin)
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    fed = loop.time() - started
+    await pipeline.stop(timeout=60)
+    await db.flush()
+    drained = loop.time() - started
+    await shipper.close(drain_timeout=30)
+    commits = db.commits - commits_before
+    await db.close()
+    await sink.stop()
+
+    latencies.sort()
+    return {
+        "updates": len(updates),
+        "errors": errors,
+        "feed_seconds": round(fed, 3),
+        "drain_seconds": round(drained, 3),
+        "updates_per_second": round(len(updates) / fed, 1) if fed else None,
+        "persisted_per_second": round(len(updates) / drained, 1) if drained else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "sqlite_commits": commits,
+        "commits_per_update": round(commits / len(updates), 4) if updates else 0.0,
+        "events_sent": shipper.sent,
+        "events_received": sink.received,
+        "events_dropped": shipper.dropped,
+        "api_calls": dict(session.calls),
+        "pipeline": pipeline.stats(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000, help="number of updates to feed")
+    parser.add_argument("--concurrency", type=int, default=32, help="updates in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 for as fast as possible")
+    parser.add_argument("--users", type=int, default=1000, help="distinct synthetic users")
+    parser.add_argument(
+        "--mix",
+        default="message=0.7,greet=0.2,callback=0.1",
+        help=f"weights of update kinds {UPDATE_KINDS}",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="database file (default: a fresh temporary one)")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--flush-interval-ms", type=int, default=50)
+    parser.add_argument("--log-workers", type=int, default=2)
+    parser.add_argument("--log-batch-size", type=int, default=100)
+    parser.add_argument("--log-backpressure", choices=BACKPRESSURE_POLICIES, default="block")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    started_at = datetime.now(tz=timezone.utc).isoformat()
+    results = asyncio.run(run_benchmark(args))
+    report = {
+        "benchmark": "pipeline",
+        "started_at": started_at,
+        "git_revision": git_revision(),
+        "config": vars(args),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Fake Telegram client that posts synthetic updates to the bot's webhook.
+
+Example::
+
+    python -m tools.fake_telegram --url http://localhost:8080/webhook \\
+        --secret "$WEBHOOK_SECRET" --text /greet --user-id 42
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from app.webhook import SECRET_HEADER
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int, first_name: str = "Test", username: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": first_name,
+        "username": username or f"user{user_id}",
+    }
+
+
+def message_update(user_id: int, text: str, first_name: str = "Test") -> Dict[str, Any]:
+    message: Dict[str, Any] = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id, first_name),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str = "get_greeting", first_name: str = "Test") -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id, first_name),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "prompt",
+            },
+        },
+    }
+
+
+async def post_update(url: str, secret: str, update: Dict[str, Any]) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=update, headers={SECRET_HEADER: secret}) as resp:
+            return resp.status
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8080/webhook")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--text", default="/start", help="message text to send")
+    parser.add_argument("--callback", help="send a callback query with this data instead")
+    args = parser.parse_args()
+    if args.callback:
+        update = callback_update(args.user_id, args.callback)
+    else:
+        update = message_update(args.user_id, args.text)
+    status = asyncio.run(post_update(args.url, args.secret, update))
+    print(f"{update['update_id']}: HTTP {status}")
+
+
+if __name__ == "__main__":
+    main()
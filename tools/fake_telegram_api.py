@@ -0,0 +1,125 @@
+"""Local stand-in for the Telegram Bot API with flood limits.
+
+Answers ``/bot<token>/<method>`` like api.telegram.org, enforces a global
+send rate and a per-chat interval with 429 ``retry_after`` responses, and can
+pretend some users blocked the bot. ``GET /stats`` reports what was received.
+Point the backend at it with TELEGRAM_API_URL=http://localhost:8081.
+
+Example::
+
+    python -m tools.fake_telegram_api --port 8081 --rate 30 --blocked-every 50
+"""
+import argparse
+import itertools
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Optional
+
+from aiohttp import web
+
+
+class FakeTelegramAPI:
+    def __init__(
+        self,
+        rate: float = 30.0,
+        chat_interval: float = 1.0,
+        blocked_every: int = 0,
+        retry_after: int = 1,
+    ) -> None:
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.blocked_every = blocked_every
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.delivered: Counter = Counter()
+        self.rejected = 0
+        self.blocked = 0
+        self._recent: Deque[float] = deque()
+        self._chat_last: Dict[int, float] = {}
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": dict(self.calls),
+            "delivered": sum(self.delivered.values()),
+            "distinct_chats": len(self.delivered),
+            "duplicates": sum(count - 1 for count in self.delivered.values() if count > 1),
+            "rejected_429": self.rejected,
+            "blocked": self.blocked,
+        }
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params: Dict[str, Any] = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        if method.lower() == "sendmessage":
+            return self._send_message(params)
+        if method.lower() == "getme":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        return self._ok(True)
+
+    def _send_message(self, params: Dict[str, Any]) -> web.Response:
+        chat_id = int(params.get("chat_id", 0))
+        now = time.monotonic()
+        while self._recent and self._recent[0] <= now - 1.0:
+            self._recent.popleft()
+        last = self._chat_last.get(chat_id)
+        if len(self._recent) >= self.rate or (last is not None and now - last < self.chat_interval):
+            self.rejected += 1
+            return self._error(
+                429,
+                f"Too Many Requests: retry after {self.retry_after}",
+                {"retry_after": self.retry_after},
+            )
+        self._recent.append(now)
+        self._chat_last[chat_id] = now
+        if self.blocked_every and chat_id % self.blocked_every == 0:
+            self.blocked += 1
+            return self._error(403, "Forbidden: bot was blocked by the user")
+        self.delivered[chat_id] += 1
+        return self._ok(
+            {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        )
+
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _error(code: int, description: str, parameters: Optional[Dict[str, Any]] = None) -> web.Response:
+        body: Dict[str, Any] = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate", type=float, default=30.0, help="sendMessage calls per second before 429")
+    parser.add_argument("--chat-interval", type=float, default=1.0, help="seconds between sends to one chat")
+    parser.add_argument("--blocked-every", type=int, default=0, help="chat ids divisible by this get 403")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    api = FakeTelegramAPI(args.rate, args.chat_interval, args.blocked_every, args.retry_after)
+    web.run_app(api.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()